@@ -2,9 +2,11 @@ from builtins import range
 from builtins import object
 import os
 import numpy as np
+import scipy.sparse
 
 from ..layers import *
 from ..layer_utils import *
+from ..model_io import save_arrays, load_arrays, is_model_file
 
 
 class TwoLayerNet(object):
@@ -30,6 +32,7 @@ class TwoLayerNet(object):
         num_classes=10,
         weight_scale=1e-3,
         reg=0.0,
+        _skip_init=False,
     ):
         """
         Initialize a new network.
@@ -41,9 +44,17 @@ class TwoLayerNet(object):
         - weight_scale: Scalar giving the standard deviation for random
           initialization of the weights.
         - reg: Scalar giving L2 regularization strength.
+        - _skip_init: If True, the parameters are left empty instead of being
+          randomly initialized; used by model_io.load_model, which sets them.
         """
         self.params = {}
         self.reg = reg
+        self.config = {
+            "input_dim": input_dim,
+            "hidden_dim": hidden_dim,
+            "num_classes": num_classes,
+            "reg": reg,
+        }
 
         ############################################################################
         # TODO: Initialize the weights and biases of the two-layer net. Weights    #
@@ -54,10 +65,11 @@ class TwoLayerNet(object):
         # and biases using the keys 'W1' and 'b1' and second layer                 #
         # weights and biases using the keys 'W2' and 'b2'.                         #
         ############################################################################
-        self.params['W1'] = weight_scale * np.random.randn(input_dim, hidden_dim)
-        self.params['b1'] = np.zeros(hidden_dim)
-        self.params['W2'] = weight_scale * np.random.randn(hidden_dim, num_classes)
-        self.params['b2'] = np.zeros(num_classes)
+        if not _skip_init:
+            self.params['W1'] = weight_scale * np.random.randn(input_dim, hidden_dim)
+            self.params['b1'] = np.zeros(hidden_dim)
+            self.params['W2'] = weight_scale * np.random.randn(hidden_dim, num_classes)
+            self.params['b2'] = np.zeros(num_classes)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -86,12 +98,23 @@ class TwoLayerNet(object):
         # TODO: Implement the forward pass for the two-layer net, computing the    #
         # class scores for X and storing them in the scores variable.              #
         ############################################################################
-        W1, b1 = self.params['W1'], self.params['b1']
-        W2, b2 = self.params['W2'], self.params['b2']
-
-        # Forward pass
-        hidden_layer, cache_hidden_layer = affine_relu_forward(X, W1, b1)
-        scores, cache_scores = affine_forward(hidden_layer, W2, b2)
+        W1, b1 = self.params.get('W1'), self.params['b1']
+        W2, b2 = self.params.get('W2'), self.params['b2']
+
+        # Forward pass. A layer whose weights were factorized into U and V (see
+        # cs231n/compression.py) stores those instead of W.
+        if 'U1' in self.params:
+            hidden_layer, cache_hidden_layer = lowrank_affine_relu_forward(
+                X, self.params['U1'], self.params['V1'], b1
+            )
+        else:
+            hidden_layer, cache_hidden_layer = affine_relu_forward(X, W1, b1)
+        if 'U2' in self.params:
+            scores, cache_scores = lowrank_affine_forward(
+                hidden_layer, self.params['U2'], self.params['V2'], b2
+            )
+        else:
+            scores, cache_scores = affine_forward(hidden_layer, W2, b2)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -115,19 +138,29 @@ class TwoLayerNet(object):
         loss, dscores = softmax_loss(scores, y)
 
         # Add L2 regularization
-        loss += 0.5 * self.reg * (np.sum(W1**2) + np.sum(W2**2))
+        weights = [k for k in self.params if k[0] in 'WUV']
+        loss += 0.5 * self.reg * sum(np.sum(self.params[k]**2) for k in weights)
 
         # Backward pass
-        dhidden, dW2, db2 = affine_backward(dscores, cache_scores)
-        dX, dW1, db1 = affine_relu_backward(dhidden, cache_hidden_layer)
+        if 'U2' in self.params:
+            dhidden, grads['U2'], grads['V2'], db2 = lowrank_affine_backward(dscores, cache_scores)
+        else:
+            dhidden, grads['W2'], db2 = affine_backward(dscores, cache_scores)
+        # Nothing consumes the gradient with respect to X, so skip computing it.
+        if 'U1' in self.params:
+            _, grads['U1'], grads['V1'], db1 = lowrank_affine_relu_backward(
+                dhidden, cache_hidden_layer, needs_input_grad=False
+            )
+        else:
+            _, grads['W1'], db1 = affine_relu_backward(
+                dhidden, cache_hidden_layer, needs_input_grad=False
+            )
 
         # Add regularization gradient contribution
-        dW1 += self.reg * W1
-        dW2 += self.reg * W2
+        for k in weights:
+            grads[k] += self.reg * self.params[k]
 
-        grads['W1'] = dW1
         grads['b1'] = db1
-        grads['W2'] = dW2
         grads['b2'] = db2
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -136,23 +169,38 @@ class TwoLayerNet(object):
         return loss, grads
 
     def save(self, fname):
-      """Save model parameters."""
+      """
+      Save model parameters and architecture config in the pickle-free format
+      of cs231n/model_io.py.
+      """
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
-      params = self.params
-      np.save(fpath, params)
+      arrays = {"params/" + k: v for k, v in self.params.items()}
+      save_arrays(fpath, arrays, {"class": type(self).__name__, "config": self.config})
       print(fname, "saved.")
     
     def load(self, fname):
-      """Load model parameters."""
+      """
+      Load model parameters. Files in the format of cs231n/model_io.py are
+      memory-mapped copy-on-write; older np.save files are still readable.
+      """
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
       if not os.path.exists(fpath):
         print(fname, "not available.")
         return False
-      else:
+      elif not is_model_file(fpath):
         params = np.load(fpath, allow_pickle=True).item()
         self.params = params
         print(fname, "loaded.")
         return True
+      else:
+        arrays, metadata = load_arrays(fpath, mmap_mode="c")
+        self.set_state(arrays, metadata)
+        print(fname, "loaded.")
+        return True
+
+    def set_state(self, arrays, metadata):
+      """Restore the model from the arrays and metadata of a saved model file."""
+      self.params = {k[len("params/"):]: v for k, v in arrays.items() if k.startswith("params/")}
 
 
 
@@ -183,6 +231,11 @@ class FullyConnectedNet(object):
         weight_scale=1e-2,
         dtype=np.float32,
         seed=None,
+        mixed_precision=False,
+        checkpoint_every=None,
+        output_loss="softmax",
+        output_loss_param=None,
+        _skip_init=False,
     ):
         """Initialize a new FullyConnectedNet.
 
@@ -202,11 +255,55 @@ class FullyConnectedNet(object):
             float64 for numeric gradient checking.
         - seed: If not None, then pass this random seed to the dropout layers.
             This will make the dropout layers deteriminstic so we can gradient check the model.
+            Otherwise every dropout layer draws its masks from its own
+            np.random.Generator stream, seeded from the global RNG so that
+            np.random.seed makes the masks reproducible.
+        - mixed_precision: If True, activations, layer caches and the gradients
+            passed between layers are stored in float16, while parameters (the
+            optimizer's master weights), matmul accumulation and normalization
+            statistics stay in float32.
+            Gradients are protected from float16 underflow by dynamic loss
+            scaling; see _unscale_grads. Requires dtype=np.float32.
+        - checkpoint_every: If not None, an integer k. The forward pass then keeps
+            only the input of every k-th hidden layer instead of all layer caches,
+            and the backward pass recomputes each segment of k layers from its
+            saved input. This lowers peak memory from O(L) to O(L / k + k) layer
+            caches at the cost of roughly one extra forward pass.
+        - output_loss: Training loss of the output layer, for large numbers of
+            classes: "softmax" (the default), "sampled_softmax" or
+            "hierarchical_softmax"; see sampled_softmax_loss and
+            hierarchical_softmax_loss. The latter adds the parameters
+            W_cluster and b_cluster. Test-time scores always cover all classes.
+        - output_loss_param: Optional dictionary of options of the output
+            loss: num_sampled (default 64) and sampler (default "log_uniform")
+            for "sampled_softmax", cluster_size (default ceil(sqrt(C))) for
+            "hierarchical_softmax".
+        - _skip_init: If True, the parameters are left empty instead of being
+            randomly initialized; used by model_io.load_model, which sets them.
         """
+        if mixed_precision and dtype != np.float32:
+            raise ValueError("mixed_precision requires dtype=np.float32")
+        if output_loss not in ("softmax", "sampled_softmax", "hierarchical_softmax"):
+            raise ValueError('Unknown output_loss "%s"' % output_loss)
+        self.config = {
+            "hidden_dims": list(hidden_dims),
+            "input_dim": input_dim,
+            "num_classes": num_classes,
+            "dropout_keep_ratio": dropout_keep_ratio,
+            "normalization": normalization,
+            "reg": reg,
+            "dtype": np.dtype(dtype).name,
+            "seed": seed,
+            "mixed_precision": mixed_precision,
+            "checkpoint_every": checkpoint_every,
+            "output_loss": output_loss,
+            "output_loss_param": dict(output_loss_param or {}),
+        }
         self.normalization = normalization
         self.use_dropout = dropout_keep_ratio != 1
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
+        self.checkpoint_every = checkpoint_every
         self.dtype = dtype
         self.params = {}
 
@@ -223,24 +320,63 @@ class FullyConnectedNet(object):
         # parameters should be initialized to zeros.                               #
         ############################################################################
         dims = [input_dim] + hidden_dims + [num_classes]
-        for i in range(1, self.num_layers + 1):
-            self.params['W%d' % i] = weight_scale * np.random.randn(dims[i-1], dims[i])
-            self.params['b%d' % i] = np.zeros(dims[i])
-            if self.normalization in ['batchnorm', 'layernorm'] and i != self.num_layers:
-                self.params['gamma%d' % i] = np.ones(dims[i])
-                self.params['beta%d' % i] = np.zeros(dims[i])
+        if not _skip_init:
+            for i in range(1, self.num_layers + 1):
+                self.params['W%d' % i] = weight_scale * np.random.randn(dims[i-1], dims[i])
+                self.params['b%d' % i] = np.zeros(dims[i])
+                if self.normalization in ['batchnorm', 'layernorm'] and i != self.num_layers:
+                    self.params['gamma%d' % i] = np.ones(dims[i])
+                    self.params['beta%d' % i] = np.zeros(dims[i])
+        self.output_loss = output_loss
+        self.output_loss_param = dict(output_loss_param or {})
+        if output_loss == "hierarchical_softmax":
+            cluster_size = self.output_loss_param.setdefault(
+                "cluster_size", int(np.ceil(np.sqrt(num_classes)))
+            )
+            num_clusters = -(-num_classes // cluster_size)
+            if not _skip_init:
+                self.params['W_cluster'] = weight_scale * np.random.randn(dims[-2], num_clusters)
+                self.params['b_cluster'] = np.zeros(num_clusters)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
 
         # When using dropout we need to pass a dropout_param dictionary to each
         # dropout layer so that the layer knows the dropout probability and the mode
-        # (train / test). You can pass the same dropout_param to each dropout layer.
-        self.dropout_param = {}
+        # (train / test). Every layer gets its own dropout_param, with a seed or
+        # a random generator spawned from a common SeedSequence, so that the
+        # layers draw independent masks without using the global RNG. Without
+        # a seed, the SeedSequence is seeded from the global RNG, so that
+        # np.random.seed still makes training reproducible; a model built by
+        # model_io.load_model leaves the global RNG alone and uses fresh
+        # entropy instead.
+        entropy = seed
+        needs_rng = self.use_dropout or output_loss == "sampled_softmax"
+        if seed is None and needs_rng and not _skip_init:
+            entropy = np.random.randint(2 ** 31)
+        seed_seq = np.random.SeedSequence(entropy)
+        self.dropout_params = []
         if self.use_dropout:
-            self.dropout_param = {"mode": "train", "p": dropout_keep_ratio}
+            seeds = seed_seq.spawn(self.num_layers - 1)
+            for child in seeds:
+                dropout_param = {"mode": "train", "p": dropout_keep_ratio}
+                if seed is not None:
+                    dropout_param["seed"] = child
+                else:
+                    dropout_param["rng"] = np.random.default_rng(child)
+                self.dropout_params.append(dropout_param)
+
+        # The classes of the sampled softmax are drawn from a stream of their
+        # own, spawned after those of the dropout layers from the same
+        # SeedSequence, so np.random.seed also fixes the sampled classes.
+        if output_loss == "sampled_softmax":
+            self.output_loss_param.setdefault("num_sampled", 64)
+            self.output_loss_param.setdefault("sampler", "log_uniform")
+            child = seed_seq.spawn(1)[0]
             if seed is not None:
-                self.dropout_param["seed"] = seed
+                self.output_loss_param["seed"] = child
+            else:
+                self.output_loss_param["rng"] = np.random.default_rng(child)
 
         # With batch normalization we need to keep track of running means and
         # variances, so we need to pass a special bn_param object to each batch
@@ -257,6 +393,33 @@ class FullyConnectedNet(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
+        # With mixed precision, the loss is multiplied by loss_scale before the
+        # backward pass so that small gradients survive the float16 storage.
+        # The scale is halved whenever the scaled gradients overflow and doubled
+        # after loss_scale_window consecutive steps without overflow. found_inf
+        # tells the Solver to skip the update of a step that overflowed.
+        self.mixed_precision = mixed_precision
+        self.act_dtype = np.float16 if mixed_precision else dtype
+        self.loss_scale = 2.0 ** 15 if mixed_precision else 1.0
+        self.loss_scale_window = 2000
+        self.found_inf = False
+        self._good_steps = 0
+
+        # Hidden layers 1, ..., num_frozen are fixed; see freeze(). When
+        # inputs_are_features is True, loss() expects the output of the frozen
+        # layers (e.g. from cache_frozen_features) instead of raw inputs.
+        self.num_frozen = 0
+        self.inputs_are_features = False
+
+        # Magnitude pruning state, managed by cs231n/compression.py. masks maps
+        # a layer index to a boolean mask of the weights that are kept, and
+        # gradients of pruned weights are zeroed so they stay at zero. Layers
+        # in sparse_layers store only their non-zero weights: params['W%d'] is
+        # then the data array of a CSR matrix whose (indices, indptr, shape)
+        # are stored in sparse_layers[i].
+        self.masks = {}
+        self.sparse_layers = {}
+
 
     def loss(self, X, y=None):
         """Compute loss and gradient for the fully connected net.
@@ -275,49 +438,49 @@ class FullyConnectedNet(object):
         - loss: Scalar value giving the loss
         - grads: Dictionary with the same keys as self.params, mapping parameter
             names to gradients of the loss with respect to those parameters.
+            Parameters of frozen layers have no entry in grads.
         """
-        X = X.astype(self.dtype)
+        X = X.astype(self.act_dtype)
         mode = "test" if y is None else "train"
 
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
-        if self.use_dropout:
-            self.dropout_param["mode"] = mode
+        for dropout_param in self.dropout_params[self.num_frozen:]:
+            dropout_param["mode"] = mode
         if self.normalization == "batchnorm":
-            for bn_param in self.bn_params:
+            for bn_param in self.bn_params[self.num_frozen:]:
                 bn_param["mode"] = mode
         scores = None
         ############################################################################
         # TODO: Implement the forward pass for the fully connected net, computing  #
         # the class scores for X and storing them in the scores variable.          #
         #                                                                          #
-        # When using dropout, you'll need to pass self.dropout_param to each       #
-        # dropout forward pass.                                                    #
+        # When using dropout, you'll need to pass self.dropout_params[i-1] to the #
+        # dropout forward pass of layer i.                                         #
         #                                                                          #
         # When using batch normalization, you'll need to pass self.bn_params[0] to #
         # the forward pass for the first batch normalization layer, pass           #
         # self.bn_params[1] to the forward pass for the second batch normalization #
         # layer, etc.                                                              #
         ############################################################################
-        hidden_layers = [X]
-        caches = []
-        for i in range(1, self.num_layers):
-            W, b = self.params['W%d' % i], self.params['b%d' % i]
-            if self.normalization == "batchnorm":
-                gamma, beta = self.params['gamma%d' % i], self.params['beta%d' % i]
-                hidden_layer, cache = affine_bn_relu_forward(hidden_layers[-1], W, b, gamma, beta, self.bn_params[i-1])
-            elif self.normalization == "layernorm":
-                gamma, beta = self.params['gamma%d' % i], self.params['beta%d' % i]
-                hidden_layer, cache = affine_ln_relu_forward(hidden_layers[-1], W, b, gamma, beta, self.bn_params[i-1])
-            else:
-                hidden_layer, cache = affine_relu_forward(hidden_layers[-1], W, b)
-            if self.use_dropout:
-                hidden_layer, dropout_cache = dropout_forward(hidden_layer, self.dropout_param)
-                cache = (cache, dropout_cache)
-            hidden_layers.append(hidden_layer)
-            caches.append(cache)
-        W, b = self.params['W%d' % self.num_layers], self.params['b%d' % self.num_layers]
-        scores, cache = affine_forward(hidden_layers[-1], W, b)
+        first = self.num_frozen + 1
+        hidden = X if self.inputs_are_features else self._frozen_forward(X)
+        caches, checkpoints = [], []
+        for i in range(first, self.num_layers):
+            if self.checkpoint_every is not None and (i - first) % self.checkpoint_every == 0:
+                checkpoints.append((i, hidden, self._dropout_rng_states()))
+            hidden, cache = self._hidden_forward(hidden, i)
+            if self.checkpoint_every is None:
+                caches.append(cache)
+        L = self.num_layers
+        if mode == "test" and self.output_loss == "hierarchical_softmax":
+            return hierarchical_softmax_scores(
+                hidden, self.params['W%d' % L], self.params['b%d' % L],
+                self.params['W_cluster'], self.params['b_cluster'],
+                self.output_loss_param["cluster_size"],
+            )
+        if mode == "test" or self.output_loss == "softmax":
+            scores, cache = self._affine_forward(hidden, L)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -340,60 +503,33 @@ class FullyConnectedNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
-            a, fc_cache = affine_forward(x, w, b)
-            bn, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
-            out, relu_cache = relu_forward(bn)
-            cache = (fc_cache, bn_cache, relu_cache)
-            return out, cache
-
-        def affine_bn_relu_backward(dout, cache):
-            fc_cache, bn_cache, relu_cache = cache
-            da = relu_backward(dout, relu_cache)
-            dbn, dgamma, dbeta = batchnorm_backward(da, bn_cache)
-            dx, dw, db = affine_backward(dbn, fc_cache)
-            return dx, dw, db, dgamma, dbeta
-
-        def affine_ln_relu_forward(x, w, b, gamma, beta, ln_param):
-            a, fc_cache = affine_forward(x, w, b)
-            ln, ln_cache = layernorm_forward(a, gamma, beta, ln_param)
-            out, relu_cache = relu_forward(ln)
-            cache = (fc_cache, ln_cache, relu_cache)
-            return out, cache
-
-        def affine_ln_relu_backward(dout, cache):
-            fc_cache, ln_cache, relu_cache = cache
-            da = relu_backward(dout, relu_cache)
-            dln, dgamma, dbeta = layernorm_backward(da, ln_cache)
-            dx, dw, db = affine_backward(dln, fc_cache)
-            return dx, dw, db, dgamma, dbeta
-        
-        loss, dscores = softmax_loss(scores, y)
-        loss += 0.5 * self.reg * sum(np.sum(self.params['W%d' % i]**2) for i in range(1, self.num_layers + 1))
-
-        dhidden = dscores
-        for i in range(self.num_layers, 0, -1):
-            W = self.params['W%d' % i]
-            if i == self.num_layers:
-                dhidden, dW, db = affine_backward(dhidden, cache)
-            else:
-               if self.use_dropout:
-                   cache, dropout_cache = caches[i-1]
-                   dhidden = dropout_backward(dhidden, dropout_cache)
-               else:
-                    cache = caches[i-1]
-               if self.normalization == "batchnorm":
-                    dhidden, dW, db, dgamma, dbeta = affine_bn_relu_backward(dhidden, cache)
-                    grads['gamma%d' % i] = dgamma
-                    grads['beta%d' % i] = dbeta
-               elif self.normalization == "layernorm":
-                    dhidden, dW, db, dgamma, dbeta = affine_ln_relu_backward(dhidden, cache)
-                    grads['gamma%d' % i] = dgamma
-                    grads['beta%d' % i] = dbeta
-               else:
-                    dhidden, dW, db = affine_relu_backward(dhidden, cache)
-            grads['W%d' % i] = dW + self.reg * W
-            grads['b%d' % i] = db
+        if self.output_loss == "softmax":
+            loss, dscores = softmax_loss(scores, y)
+            if self.mixed_precision:
+                dscores *= self.loss_scale
+            # The gradient with respect to the input of the first trainable layer
+            # is never used, so that affine layer skips computing it.
+            dhidden = self._affine_backward(dscores, cache, L, grads, needs_input_grad=L > first)
+        else:
+            loss, dhidden = self._output_loss_backward(hidden, y, grads)
+        loss += 0.5 * self.reg * sum(np.sum(self.params[k]**2) for k in self._weight_names(1))
+
+        for i in range(self.num_layers - 1, first - 1, -1):
+            if not caches:
+                start, x, rng_states = checkpoints.pop()
+                caches = self._recompute_segment(x, start, i + 1, rng_states)
+            if self.mixed_precision:
+                # Overflow shows up as inf and is handled by _unscale_grads.
+                with np.errstate(over='ignore'):
+                    dhidden = dhidden.astype(np.float16)
+            dhidden = self._hidden_backward(
+                dhidden, caches.pop(), i, grads, needs_input_grad=i > first
+            )
+        if self.mixed_precision:
+            self._unscale_grads(grads)
+
+        for k in self._weight_names(first):
+            grads[k] += self.reg * self.params[k]
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
@@ -401,21 +537,374 @@ class FullyConnectedNet(object):
         return loss, grads
 
 
+    def freeze(self, num_layers):
+        """
+        Mark hidden layers 1, ..., num_layers as fixed so that only the layers
+        above them are trained. Frozen layers always run in test mode: batchnorm
+        uses its running averages and dropout is disabled, so their output is a
+        fixed function of the input that can be precomputed with
+        cache_frozen_features. Call freeze(0) to unfreeze all layers.
+        """
+        if not 0 <= num_layers < self.num_layers:
+            raise ValueError("Can freeze between 0 and %d layers" % (self.num_layers - 1))
+        self.num_frozen = num_layers
+        if self.normalization == "batchnorm":
+            for bn_param in self.bn_params[:num_layers]:
+                bn_param["mode"] = "test"
+        for dropout_param in self.dropout_params[:num_layers]:
+            dropout_param["mode"] = "test"
+
+    def _frozen_forward(self, X):
+        """Run the frozen hidden layers on X in test mode and return their output."""
+        for i in range(1, self.num_frozen + 1):
+            X, _ = self._hidden_forward(X, i)
+        return X
+
+    def frozen_features(self, X, batch_size=1000, mmap_path=None):
+        """
+        Compute the output of the frozen layers for a whole dataset.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+        - batch_size: Number of examples to run through the frozen layers at once.
+        - mmap_path: If not None, write the features to a .npy file at this path
+          and return it as a memory-mapped array instead of keeping it in RAM.
+
+        Returns:
+        - features: Array of shape (N, H) where H is the size of the last frozen layer.
+        """
+        N = X.shape[0]
+        H = self.params['b%d' % self.num_frozen].shape[0] if self.num_frozen else int(np.prod(X.shape[1:]))
+        shape = (N, H)
+        if mmap_path is None:
+            features = np.empty(shape, dtype=self.act_dtype)
+        else:
+            features = np.lib.format.open_memmap(mmap_path, mode="w+", dtype=self.act_dtype, shape=shape)
+        for start in range(0, N, batch_size):
+            X_batch = X[start:start + batch_size].astype(self.act_dtype)
+            features[start:start + batch_size] = self._frozen_forward(X_batch).reshape(-1, H)
+        return features
+
+    def cache_frozen_features(self, data, batch_size=1000, mmap_dir=None):
+        """
+        Precompute the frozen-layer features of every 'X_*' array in a data
+        dictionary, so that a Solver only runs the unfrozen layers:
+
+        model.freeze(2)
+        solver = Solver(model, model.cache_frozen_features(data), ...)
+
+        After this call loss() expects features rather than raw inputs; set
+        model.inputs_are_features = False to feed raw inputs again.
+
+        Inputs:
+        - data: Dictionary such as the one passed to Solver.
+        - batch_size: Number of examples to run through the frozen layers at once.
+        - mmap_dir: If not None, store each feature array in mmap_dir/<key>.npy
+          as a memory-mapped file instead of in RAM.
+
+        Returns:
+        - A copy of data in which every 'X_*' array is replaced by its features.
+        """
+        cached = dict(data)
+        for k, v in data.items():
+            if k.startswith("X_"):
+                mmap_path = None if mmap_dir is None else os.path.join(mmap_dir, k + ".npy")
+                cached[k] = self.frozen_features(v, batch_size, mmap_path)
+        self.inputs_are_features = True
+        return cached
+
+    def _weight_names(self, first):
+        """
+        Names of the weights of layers first, ..., L: 'W%d', or 'U%d' and 'V%d'
+        for layers factorized by cs231n/compression.py.
+        """
+        names = []
+        for i in range(first, self.num_layers + 1):
+            if 'U%d' % i in self.params:
+                names += ['U%d' % i, 'V%d' % i]
+            else:
+                names.append('W%d' % i)
+        if 'W_cluster' in self.params:
+            names.append('W_cluster')
+        return names
+
+    def _output_loss_backward(self, x, y, grads):
+        """
+        Loss and backward pass of the output layer for the sampled and
+        hierarchical softmax losses, which never compute the full scores.
+        Stores the parameter gradients in grads and returns the loss and the
+        gradient with respect to x; with mixed precision, the gradients are
+        multiplied by the loss scale like those of the softmax path.
+        """
+        L = self.num_layers
+        if 'U%d' % L in self.params or L in self.sparse_layers:
+            raise ValueError("%s needs a dense output layer" % self.output_loss)
+        w, b = self.params['W%d' % L], self.params['b%d' % L]
+        if self.output_loss == "sampled_softmax":
+            loss, dx, dw, db = sampled_softmax_loss(x, w, b, y, self.output_loss_param)
+        else:
+            loss, dx, dw, db, dw_cluster, db_cluster = hierarchical_softmax_loss(
+                x, w, b, self.params['W_cluster'], self.params['b_cluster'], y,
+                self.output_loss_param["cluster_size"],
+            )
+            grads['W_cluster'], grads['b_cluster'] = dw_cluster, db_cluster
+        if L in self.masks:
+            dw *= self.masks[L]
+        grads['W%d' % L], grads['b%d' % L] = dw, db
+        if self.mixed_precision:
+            for k in ('W%d' % L, 'b%d' % L, 'W_cluster', 'b_cluster'):
+                if k in grads:
+                    grads[k] *= self.loss_scale
+            dx *= self.loss_scale
+        return loss, dx
+
+    def _affine_forward(self, x, i):
+        """Forward pass for the affine part of layer i, dense or factorized."""
+        b = self.params['b%d' % i]
+        if 'U%d' % i in self.params:
+            return lowrank_affine_forward(x, self.params['U%d' % i], self.params['V%d' % i], b)
+        if i in self.sparse_layers:
+            indices, indptr, shape = self.sparse_layers[i]
+            w = scipy.sparse.csr_matrix((self.params['W%d' % i], indices, indptr), shape=shape)
+            return sparse_affine_forward(x, w, b)
+        return affine_forward(x, self.params['W%d' % i], b)
+
+    def _affine_backward(self, dout, cache, i, grads, needs_input_grad=True):
+        """
+        Backward pass for the affine part of layer i. Stores its parameter
+        gradients in grads and returns the gradient with respect to its input.
+        """
+        if 'U%d' % i in self.params:
+            dx, grads['U%d' % i], grads['V%d' % i], grads['b%d' % i] = lowrank_affine_backward(
+                dout, cache, needs_input_grad
+            )
+        elif i in self.sparse_layers:
+            dx, grads['W%d' % i], grads['b%d' % i] = sparse_affine_backward(
+                dout, cache, needs_input_grad
+            )
+        else:
+            dx, grads['W%d' % i], grads['b%d' % i] = affine_backward(dout, cache, needs_input_grad)
+            if i in self.masks:
+                grads['W%d' % i] *= self.masks[i]
+        return dx
+
+    def _hidden_forward(self, x, i):
+        """
+        Forward pass for hidden layer i: affine - [batch/layer norm] - relu -
+        [dropout]. Returns the layer output and a cache for _hidden_backward.
+        """
+        a, fc_cache = self._affine_forward(x, i)
+        norm_cache = None
+        if self.normalization == "batchnorm":
+            gamma, beta = self.params['gamma%d' % i], self.params['beta%d' % i]
+            a, norm_cache = batchnorm_forward_fused(a, gamma, beta, self.bn_params[i-1])
+        elif self.normalization == "layernorm":
+            gamma, beta = self.params['gamma%d' % i], self.params['beta%d' % i]
+            a, norm_cache = layernorm_forward(a, gamma, beta, self.bn_params[i-1])
+        # With mixed precision the normalization statistics above are still
+        # computed in float32, since squared activations easily overflow
+        # float16; everything from here on is stored in float16.
+        a = a.astype(self.act_dtype, copy=False)
+        out, relu_cache = relu_forward(a)
+        dropout_cache = None
+        if self.use_dropout:
+            out, dropout_cache = dropout_forward(out, self.dropout_params[i-1])
+        return out, (fc_cache, norm_cache, relu_cache, dropout_cache)
+
+    def _hidden_backward(self, dout, cache, i, grads, needs_input_grad=True):
+        """
+        Backward pass for hidden layer i. Stores the parameter gradients of the
+        layer in grads and returns the gradient with respect to its input, or
+        None if needs_input_grad is False.
+        """
+        fc_cache, norm_cache, relu_cache, dropout_cache = cache
+        # Accumulate in float32 even when dout and the caches are float16.
+        dout = dout.astype(self.dtype, copy=False)
+        if self.use_dropout:
+            dout = dropout_backward(dout, dropout_cache)
+        da = relu_backward(dout, relu_cache)
+        if self.normalization == "batchnorm":
+            da, grads['gamma%d' % i], grads['beta%d' % i] = batchnorm_backward_fused(da, norm_cache)
+        elif self.normalization == "layernorm":
+            da, grads['gamma%d' % i], grads['beta%d' % i] = layernorm_backward(da, norm_cache)
+        return self._affine_backward(da, fc_cache, i, grads, needs_input_grad)
+
+    def _dropout_rng_states(self):
+        """
+        Return the states of the random generators of the dropout layers, or
+        None if no dropout layer draws from a generator stream.
+        """
+        if not any("rng" in p for p in self.dropout_params):
+            return None
+        return [p["rng"].bit_generator.state for p in self.dropout_params]
+
+    def _set_dropout_rng_states(self, states):
+        for dropout_param, state in zip(self.dropout_params, states):
+            dropout_param["rng"].bit_generator.state = state
+
+    def _recompute_segment(self, x, start, end, rng_states):
+        """
+        Rerun the forward pass of hidden layers start, ..., end - 1 from their
+        saved input x and return their caches. Dropout masks are reproduced by
+        replaying the generator states saved during the original forward pass,
+        and batchnorm running averages are not updated a second time.
+        """
+        bn_params = self.bn_params
+        self.bn_params = [dict(bn_param) for bn_param in bn_params]
+        if rng_states is not None:
+            outer_states = self._dropout_rng_states()
+            self._set_dropout_rng_states(rng_states)
+        caches = []
+        for i in range(start, end):
+            x, cache = self._hidden_forward(x, i)
+            caches.append(cache)
+        if rng_states is not None:
+            self._set_dropout_rng_states(outer_states)
+        self.bn_params = bn_params
+        return caches
+
+    def cache_report(self, X):
+        """
+        Run one training-mode forward pass on X and measure the memory held
+        by the layer caches, i.e. the activations kept for the backward pass.
+        Batchnorm running averages and dropout generators are left unchanged.
+        Compare the report with and without layers.set_lean_caches(True).
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+
+        Returns:
+        A list with one dictionary per trainable layer, with keys:
+        - layer: The layer index i
+        - affine, norm, relu, dropout: Bytes held by the caches of each part
+          of the layer; arrays shared with the parameters or with earlier
+          caches are not counted.
+        - total: Sum of the above
+        """
+        # The pass runs on copies of the batchnorm params, and the dropout
+        # modes and generator states are restored afterwards, so that the
+        # model is left exactly as it was, in train or test mode.
+        bn_params = self.bn_params
+        self.bn_params = [dict(bn_param) for bn_param in bn_params]
+        if self.normalization == "batchnorm":
+            for bn_param in self.bn_params[self.num_frozen:]:
+                bn_param["mode"] = "train"
+        dropout_modes = [dropout_param["mode"] for dropout_param in self.dropout_params]
+        for dropout_param in self.dropout_params[self.num_frozen:]:
+            dropout_param["mode"] = "train"
+        rng_states = self._dropout_rng_states()
+
+        try:
+            seen = set()
+            cache_nbytes(list(self.params.values()), seen)
+            hidden = X.astype(self.act_dtype)
+            if not self.inputs_are_features:
+                hidden = self._frozen_forward(hidden)
+            # All caches are kept alive until the end, as during training; this
+            # also keeps the ids in seen from being reused by new arrays.
+            report, caches = [], []
+            for i in range(self.num_frozen + 1, self.num_layers + 1):
+                if i < self.num_layers:
+                    hidden, cache = self._hidden_forward(hidden, i)
+                else:
+                    _, cache = self._affine_forward(hidden, i)
+                    cache = (cache, None, None, None)
+                caches.append(cache)
+                entry = {"layer": i}
+                for name, part in zip(("affine", "norm", "relu", "dropout"), cache):
+                    entry[name] = cache_nbytes(part, seen)
+                entry["total"] = sum(entry[name] for name in ("affine", "norm", "relu", "dropout"))
+                report.append(entry)
+        finally:
+            self.bn_params = bn_params
+            for dropout_param, mode in zip(self.dropout_params, dropout_modes):
+                dropout_param["mode"] = mode
+            if rng_states is not None:
+                self._set_dropout_rng_states(rng_states)
+        return report
+
+    def _unscale_grads(self, grads):
+        """
+        Divide the gradients of a loss-scaled backward pass by the loss scale,
+        set self.found_inf if any of them overflowed, and update the scale.
+        """
+        inv_scale = 1.0 / self.loss_scale
+        self.found_inf = False
+        for g in grads.values():
+            g *= inv_scale
+            if not np.all(np.isfinite(g)):
+                self.found_inf = True
+        if self.found_inf:
+            self.loss_scale /= 2.0
+            self._good_steps = 0
+        else:
+            self._good_steps += 1
+            if self._good_steps == self.loss_scale_window:
+                self.loss_scale *= 2.0
+                self._good_steps = 0
+
     def save(self, fname):
-      """Save model parameters."""
+      """
+      Save model parameters, batchnorm running averages, pruning state and
+      architecture config in the pickle-free format of cs231n/model_io.py.
+      """
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
-      params = self.params
-      np.save(fpath, params)
+      arrays = {"params/" + k: v for k, v in self.params.items()}
+      for j, bn_param in enumerate(self.bn_params):
+        for key in ("running_mean", "running_var"):
+          if key in bn_param:
+            arrays["bn_params/%d/%s" % (j, key)] = bn_param[key]
+      for i, mask in self.masks.items():
+        arrays["masks/%d" % i] = mask
+      sparse_shapes = {}
+      for i, (indices, indptr, shape) in self.sparse_layers.items():
+        arrays["sparse_layers/%d/indices" % i] = indices
+        arrays["sparse_layers/%d/indptr" % i] = indptr
+        sparse_shapes[str(i)] = list(shape)
+      metadata = {
+        "class": type(self).__name__,
+        "config": self.config,
+        "sparse_shapes": sparse_shapes,
+        "num_frozen": self.num_frozen,
+      }
+      save_arrays(fpath, arrays, metadata)
       print(fname, "saved.")
     
     def load(self, fname):
-      """Load model parameters."""
+      """
+      Load model parameters. Files in the format of cs231n/model_io.py are
+      memory-mapped copy-on-write; older np.save files are still readable.
+      """
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
       if not os.path.exists(fpath):
         print(fname, "not available.")
         return False
-      else:
+      elif not is_model_file(fpath):
         params = np.load(fpath, allow_pickle=True).item()
         self.params = params
         print(fname, "loaded.")
-        return True
\ No newline at end of file
+        return True
+      else:
+        arrays, metadata = load_arrays(fpath, mmap_mode="c")
+        self.set_state(arrays, metadata)
+        print(fname, "loaded.")
+        return True
+
+    def set_state(self, arrays, metadata):
+      """Restore the model from the arrays and metadata of a saved model file."""
+      self.params = {}
+      self.masks = {}
+      self.sparse_layers = {}
+      for name, arr in arrays.items():
+        parts = name.split("/")
+        if parts[0] == "params":
+          self.params[parts[1]] = arr
+        elif parts[0] == "bn_params":
+          self.bn_params[int(parts[1])][parts[2]] = arr
+        elif parts[0] == "masks":
+          self.masks[int(parts[1])] = arr
+      for i, shape in metadata.get("sparse_shapes", {}).items():
+        indices = arrays["sparse_layers/%s/indices" % i]
+        indptr = arrays["sparse_layers/%s/indptr" % i]
+        self.sparse_layers[int(i)] = (indices, indptr, tuple(shape))
+      self.freeze(metadata.get("num_frozen", 0))
\ No newline at end of file
@@ -5,6 +5,7 @@ from builtins import range
 from builtins import object
 import numpy as np
 from ..classifiers.softmax import *
+from ..model_io import save_arrays, load_arrays, is_model_file
 from past.builtins import xrange
 
 
@@ -132,23 +133,34 @@ class LinearClassifier(object):
         pass
 
     def save(self, fname):
-      """Save model parameters."""
+      """Save model parameters in the pickle-free format of cs231n/model_io.py."""
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
-      params = {"W": self.W}
-      np.save(fpath, params)
+      save_arrays(fpath, {"params/W": self.W}, {"class": type(self).__name__})
       print(fname, "saved.")
     
     def load(self, fname):
-      """Load model parameters."""
+      """
+      Load model parameters. Files in the format of cs231n/model_io.py are
+      memory-mapped copy-on-write; older np.save files are still readable.
+      """
       fpath = os.path.join(os.path.dirname(__file__), "../saved/", fname)
       if not os.path.exists(fpath):
         print(fname, "not available.")
         return False
-      else:
+      elif not is_model_file(fpath):
         params = np.load(fpath, allow_pickle=True).item()
         self.W = params["W"]
         print(fname, "loaded.")
         return True
+      else:
+        arrays, metadata = load_arrays(fpath, mmap_mode="c")
+        self.set_state(arrays, metadata)
+        print(fname, "loaded.")
+        return True
+
+    def set_state(self, arrays, metadata):
+      """Restore the model from the arrays and metadata of a saved model file."""
+      self.W = arrays["params/W"]
 
 
 class LinearSVM(LinearClassifier):
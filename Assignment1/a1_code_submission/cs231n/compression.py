@@ -0,0 +1,226 @@
+from builtins import range
+import copy
+import time
+
+import numpy as np
+import scipy.sparse
+
+from .quantization import accuracy_and_time
+from .solver import Solver
+
+"""
+Compression tools for the fully-connected models in classifiers/fc_net.py
+(TwoLayerNet and FullyConnectedNet).
+
+Low-rank factorization replaces the weight matrix W (D, M) of chosen affine
+layers by two factors U (D, r) and V (r, M) obtained from a truncated SVD, so
+that the layer costs O(r * (D + M)) instead of O(D * M) per example. The models
+detect factorized layers by the presence of 'U%d' and 'V%d' in model.params
+and use lowrank_affine_forward / lowrank_affine_backward for them.
+
+Magnitude pruning (FullyConnectedNet only) zeroes the smallest weights of each
+affine layer and keeps them at zero through retraining with a mask. Once a
+layer is sparse enough it is stored in CSR form and runs through
+sparse_affine_forward / sparse_affine_backward, so that its compute and
+storage scale with the number of remaining weights.
+
+Typical usage:
+
+results = lowrank_sweep(model, [16, 32, 64], data, layers=[1],
+                        finetune={'update_rule': 'adam', 'num_epochs': 1})
+results = pruning_sweep(model, [0.5, 0.8, 0.9, 0.95], data,
+                        finetune={'update_rule': 'adam', 'num_epochs': 1})
+"""
+
+
+def factorize_layers(model, layers, rank):
+    """
+    Replace the weights of the given affine layers by a rank-r factorization.
+    The model is modified in place.
+
+    Inputs:
+    - model: A TwoLayerNet or FullyConnectedNet
+    - layers: Iterable of layer indices, e.g. [1] for the first affine layer
+    - rank: Integer rank r; it is clipped to min(D, M) for each layer
+
+    Returns:
+    - model: The same model, for convenience
+    """
+    for i in layers:
+        W = model.params.pop("W%d" % i)
+        U, S, Vt = np.linalg.svd(W, full_matrices=False)
+        r = min(rank, S.shape[0])
+        sqrt_s = np.sqrt(S[:r])
+        model.params["U%d" % i] = (U[:, :r] * sqrt_s).astype(W.dtype)
+        model.params["V%d" % i] = (sqrt_s[:, None] * Vt[:r]).astype(W.dtype)
+    return model
+
+
+def lowrank_sweep(model, ranks, data, layers=(1,), finetune=None, batch_size=100,
+                  num_repeats=3):
+    """
+    Measure the accuracy, size and inference speed of factorized copies of a
+    trained model for several ranks. The original model is not modified.
+
+    Inputs:
+    - model: A trained TwoLayerNet or FullyConnectedNet
+    - ranks: List of ranks to try
+    - data: Dictionary with 'X_val' and 'y_val', plus 'X_train' and 'y_train'
+      when finetune is given
+    - layers: Layer indices to factorize
+    - finetune: If not None, a dictionary of keyword arguments for a Solver
+      that fine-tunes each factorized model on data before it is evaluated
+    - batch_size: Batch size used for inference
+    - num_repeats: Latencies are the best of this many passes over X_val
+
+    Returns:
+    A list with one dictionary per rank, preceded by one for the original model
+    (rank None), with keys:
+    - rank, val_acc: The rank and the validation accuracy
+    - num_params, bytes: Number and size of the model parameters
+    - time, speedup: Seconds for one pass over X_val and the speedup over the
+      original model
+    """
+    results = []
+    base_time = None
+    for rank in [None] + list(ranks):
+        m = copy.deepcopy(model)
+        if rank is not None:
+            factorize_layers(m, layers, rank)
+            if finetune is not None:
+                Solver(m, data, **finetune).train()
+        times = []
+        for _ in range(num_repeats):
+            val_acc, t = accuracy_and_time(m, data["X_val"], data["y_val"], batch_size)
+            times.append(t)
+        if base_time is None:
+            base_time = min(times)
+        results.append({
+            "rank": rank,
+            "val_acc": val_acc,
+            "num_params": sum(v.size for v in m.params.values()),
+            "bytes": sum(v.nbytes for v in m.params.values()),
+            "time": min(times),
+            "speedup": base_time / min(times),
+        })
+    return results
+
+
+def dense_weights(model, i):
+    """Return the weights of affine layer i of a pruned model as a dense array."""
+    if i in model.sparse_layers:
+        indices, indptr, shape = model.sparse_layers[i]
+        return scipy.sparse.csr_matrix(
+            (model.params["W%d" % i], indices, indptr), shape=shape
+        ).toarray()
+    return model.params["W%d" % i]
+
+
+def prune_by_magnitude(model, sparsity, layers=None, sparse_threshold=0.9):
+    """
+    Prune the smallest-magnitude weights of the given layers of a
+    FullyConnectedNet in place. Weights that were pruned before stay pruned,
+    so calling this with increasing sparsities between rounds of fine-tuning
+    implements iterative magnitude pruning.
+
+    Inputs:
+    - model: A FullyConnectedNet
+    - sparsity: Fraction of the weights of each layer to set to zero
+    - layers: Layer indices to prune; default is all affine layers
+    - sparse_threshold: Layers whose sparsity is at least this value are
+      switched to CSR storage; the others keep dense weights and a mask.
+
+    Returns:
+    - model: The same model, for convenience
+    """
+    if layers is None:
+        layers = range(1, model.num_layers + 1)
+    for i in layers:
+        W = dense_weights(model, i)
+        if i in model.sparse_layers:
+            keep = np.zeros(W.shape, dtype=bool)
+            indices, indptr, _ = model.sparse_layers[i]
+            keep[np.repeat(np.arange(W.shape[0]), np.diff(indptr)), indices] = True
+        else:
+            keep = model.masks.get(i, np.ones(W.shape, dtype=bool)).copy()
+
+        # Pruned weights get magnitude -1 so they are always pruned first.
+        num_pruned = int(round(sparsity * W.size))
+        if num_pruned > 0:
+            magnitude = np.where(keep, np.abs(W), -1).ravel()
+            keep.ravel()[np.argpartition(magnitude, num_pruned - 1)[:num_pruned]] = False
+
+        if 1.0 - keep.mean() >= sparse_threshold:
+            rows, cols = np.nonzero(keep)
+            w = scipy.sparse.csr_matrix((W[rows, cols], (rows, cols)), shape=W.shape)
+            model.params["W%d" % i] = w.data
+            model.sparse_layers[i] = (w.indices, w.indptr, W.shape)
+            model.masks.pop(i, None)
+        else:
+            model.params["W%d" % i] = W * keep
+            model.masks[i] = keep
+            model.sparse_layers.pop(i, None)
+    return model
+
+
+def pruning_sweep(model, sparsities, data, layers=None, finetune=None,
+                  sparse_threshold=0.9, batch_size=100, num_repeats=3):
+    """
+    Run iterative magnitude pruning on a copy of a trained FullyConnectedNet and
+    measure accuracy and throughput after every pruning round, giving a
+    sparsity-versus-throughput curve. The original model is not modified.
+
+    Inputs:
+    - model: A trained FullyConnectedNet
+    - sparsities: Increasing list of target sparsities, e.g. [0.5, 0.8, 0.9]
+    - data: Dictionary with 'X_train', 'y_train', 'X_val' and 'y_val'
+    - layers, sparse_threshold: Passed to prune_by_magnitude
+    - finetune: If not None, a dictionary of keyword arguments for a Solver
+      that retrains the pruned model after every round
+    - batch_size: Batch size used to measure inference and training throughput
+    - num_repeats: Timings are the best of this many repetitions
+
+    Returns:
+    A list with one dictionary per round, preceded by one for the original
+    model (sparsity 0), with keys:
+    - sparsity, val_acc: Target sparsity and validation accuracy
+    - nnz, bytes: Number of stored weights and size of all parameters
+    - num_sparse_layers: Number of layers using CSR storage
+    - inference_throughput: Validation examples per second at test time
+    - train_step_time: Seconds for one forward and backward pass on a batch
+    """
+    m = copy.deepcopy(model)
+    X_batch = data["X_train"][:batch_size]
+    y_batch = data["y_train"][:batch_size]
+    results = []
+    for sparsity in [0.0] + list(sparsities):
+        if sparsity > 0:
+            prune_by_magnitude(m, sparsity, layers, sparse_threshold)
+            if finetune is not None:
+                Solver(m, data, **finetune).train()
+        # A training-mode pass updates the batchnorm running averages and
+        # advances the dropout generators, so the step is timed on a copy to
+        # leave the evaluated model untouched.
+        step_model = copy.deepcopy(m)
+        times, step_times = [], []
+        for _ in range(num_repeats):
+            val_acc, t = accuracy_and_time(m, data["X_val"], data["y_val"], batch_size)
+            times.append(t)
+            tic = time.perf_counter()
+            step_model.loss(X_batch, y_batch)
+            step_times.append(time.perf_counter() - tic)
+        nnz = 0
+        for i in range(1, m.num_layers + 1):
+            W = m.params["W%d" % i]
+            nnz += W.size if i in m.sparse_layers else np.count_nonzero(W)
+        results.append({
+            "sparsity": sparsity,
+            "val_acc": val_acc,
+            "nnz": nnz,
+            "bytes": sum(v.nbytes for v in m.params.values())
+            + sum(ind.nbytes + ptr.nbytes for ind, ptr, _ in m.sparse_layers.values()),
+            "num_sparse_layers": len(m.sparse_layers),
+            "inference_throughput": data["X_val"].shape[0] / min(times),
+            "train_step_time": min(step_times),
+        })
+    return results
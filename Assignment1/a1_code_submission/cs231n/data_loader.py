@@ -0,0 +1,186 @@
+from __future__ import division
+from builtins import object, range
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+"""
+A minibatch loader that prepares the next minibatches in a background thread
+while the model computes on the current one.
+
+The loader owns a ring of num_buffers preallocated batch buffers. A worker
+thread takes a free buffer, gathers the next minibatch into it with np.take
+(converting it to the requested dtype), optionally augments it in
+place, and hands it to the training thread, which returns the buffer to the
+ring when it asks for the following minibatch. No arrays are allocated per
+batch, and since numpy releases the GIL for the gather and for most array
+operations, the loading overlaps with the forward and backward passes.
+
+Examples are visited in a new random order on every pass over the data
+(shuffling without replacement); a minibatch that reaches the end of one pass
+is completed with examples from the next one, so all minibatches are full.
+"""
+
+
+class PrefetchLoader(object):
+    """
+    Background-prefetching minibatch loader.
+
+    Example usage:
+
+    loader = PrefetchLoader(X_train, y_train, batch_size=200, dtype=np.float32)
+    with loader:
+        for t in range(num_iterations):
+            X_batch, y_batch = loader.next_batch()
+            loss, grads = model.loss(X_batch, y_batch)
+            ...
+    print(loader.overlap_ratio())
+    """
+
+    def __init__(
+        self, X, y, batch_size, num_buffers=3, dtype=None, augment=None, seed=None
+    ):
+        """
+        Inputs:
+        - X: Array of data, of shape (N, d_1, ..., d_k). It may be a memory map.
+        - y: Array of labels, of shape (N,)
+        - batch_size: Number of examples per minibatch
+        - num_buffers: Number of batch buffers in the ring; the worker can be
+          up to num_buffers - 1 minibatches ahead of the training thread.
+        - dtype: Dtype of the minibatches of X; defaults to the dtype of X.
+        - augment: Optional function augment(X_batch, rng) that augments a
+          minibatch in place, e.g. with random flips, called in the worker
+          thread with the loader's np.random.Generator.
+        - seed: Seed of the generator used for shuffling and augmentation.
+        """
+        if num_buffers < 2:
+            raise ValueError("PrefetchLoader needs at least 2 buffers")
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.augment = augment
+        self.rng = np.random.default_rng(seed)
+        dtype = X.dtype if dtype is None else dtype
+        self.X_buffers = np.empty((num_buffers, batch_size) + X.shape[1:], dtype=dtype)
+        self.y_buffers = np.empty((num_buffers, batch_size), dtype=y.dtype)
+        # np.take cannot convert dtypes, so a conversion gathers into this
+        # buffer first and then casts into the ring buffer.
+        self._staging = None
+        if self.X_buffers.dtype != X.dtype:
+            self._staging = np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for i in range(num_buffers):
+            self._free.put(i)
+        self._current = None
+        self._order = np.empty(0, dtype=np.int64)
+        self._position = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Seconds spent by the worker preparing minibatches, and by the
+        # training thread waiting for them.
+        self.load_time = 0.0
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+    def _next_indices(self):
+        """Indices of the next minibatch, drawn without replacement per pass."""
+        parts = []
+        needed = self.batch_size
+        while needed > 0:
+            if self._position == len(self._order):
+                self._order = self.rng.permutation(self.X.shape[0])
+                self._position = 0
+            part = self._order[self._position:self._position + needed]
+            self._position += len(part)
+            needed -= len(part)
+            parts.append(part)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def _work(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    i = self._free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                start = time.perf_counter()
+                idx = self._next_indices()
+                idx.sort()  # Gathering in index order reads X sequentially.
+                if self._staging is None:
+                    np.take(self.X, idx, axis=0, out=self.X_buffers[i])
+                else:
+                    np.take(self.X, idx, axis=0, out=self._staging)
+                    np.copyto(self.X_buffers[i], self._staging, casting="unsafe")
+                np.take(self.y, idx, axis=0, out=self.y_buffers[i])
+                if self.augment is not None:
+                    self.augment(self.X_buffers[i], self.rng)
+                self.load_time += time.perf_counter() - start
+                self._ready.put(i)
+        except BaseException as e:
+            self._ready.put(e)
+
+    def start(self):
+        """Start the worker thread. Called by next_batch if needed."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """Stop the worker thread. The loader can be restarted with start()."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_batch(self):
+        """
+        Return the next minibatch. The arrays are views of a ring buffer that
+        is reused once next_batch is called again, so they must not be kept
+        beyond that.
+
+        Returns a tuple of:
+        - X_batch: Array of shape (batch_size, d_1, ..., d_k)
+        - y_batch: Array of shape (batch_size,)
+        """
+        self.start()
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        start = time.perf_counter()
+        i = self._ready.get()
+        self.wait_time += time.perf_counter() - start
+        if isinstance(i, BaseException):
+            self.close()
+            raise i
+        self._current = i
+        self.num_batches += 1
+        return self.X_buffers[i], self.y_buffers[i]
+
+    def overlap_ratio(self):
+        """
+        Fraction of the loading time that was hidden behind computation:
+        1 - wait_time / load_time, clipped to [0, 1]. A value of 1 means the
+        training thread never waited for data; 0 means that loading was as
+        slow as with synchronous loading, or slower.
+        """
+        if self.load_time == 0:
+            return 0.0
+        return min(max(1.0 - self.wait_time / self.load_time, 0.0), 1.0)
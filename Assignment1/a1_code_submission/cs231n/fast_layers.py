@@ -0,0 +1,550 @@
+from builtins import range
+from builtins import object
+import json
+import os
+import time
+
+import numpy as np
+
+from .im2col import im2col, col2im, window_view, _pad
+from .layers import conv_forward_naive, conv_backward_naive, lean_caches_enabled
+
+"""
+Fast implementations of the convolutional layers in layers.py. They take the
+same arguments and return the same values as their naive counterparts, so
+they can be swapped in wherever the naive layers are used.
+
+The fast layers also accept a 'layout' key in conv_param / pool_param. With
+layout 'NHWC', inputs and outputs are channels-last, of shape (N, H, W, C),
+and are processed in that layout without transposing them; filters keep the
+shape (F, C, HH, WW). A stack of NHWC layers, together with
+spatial_batchnorm_forward and spatial_groupnorm_forward in the same layout,
+runs without any per-layer transpose copies.
+"""
+
+
+def _conv_shapes(x, w, conv_param):
+    """Return (N, C, H, W, F, HH, WW, stride, pad, layout) of a convolution."""
+    layout = conv_param.get("layout", "NCHW")
+    if layout == "NHWC":
+        N, H, W, C = x.shape
+    else:
+        N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    return N, C, H, W, F, HH, WW, conv_param["stride"], conv_param["pad"], layout
+
+
+def conv_forward_im2col(x, w, b, conv_param):
+    """
+    A fast implementation of the forward pass for a convolutional layer based
+    on im2col and a single matrix multiply.
+
+    Inputs and outputs are the same as for conv_forward_naive, except that
+    conv_param may contain a 'layout' key ('NCHW' or 'NHWC'), and that the
+    cache is (x, w, b, conv_param, x_cols). In lean cache mode x_cols, which
+    is HH * WW / stride**2 times the size of x, is not cached but recomputed
+    by the backward pass.
+    """
+    N, C, H, W, F, HH, WW, stride, pad, layout = _conv_shapes(x, w, conv_param)
+    H_out = 1 + (H + 2 * pad - HH) // stride
+    W_out = 1 + (W + 2 * pad - WW) // stride
+
+    x_cols = im2col(x, HH, WW, stride, pad, layout)
+    if layout == "NHWC":
+        w_mat = w.transpose(2, 3, 1, 0).reshape(-1, F)
+        out = (x_cols.dot(w_mat) + b).reshape(N, H_out, W_out, F)
+    else:
+        out = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+        out = out.reshape(F, N, H_out, W_out).transpose(1, 0, 2, 3)
+        out = np.ascontiguousarray(out)
+
+    cache = (x, w, b, conv_param, None if lean_caches_enabled() else x_cols)
+    return out, cache
+
+
+def conv_backward_im2col(dout, cache, needs_input_grad=True):
+    """
+    A fast implementation of the backward pass for a convolutional layer based
+    on im2col and col2im.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, F, H', W'), or (N, H', W', F)
+      for layout 'NHWC'
+    - cache: A tuple of (x, w, b, conv_param, x_cols) as in conv_forward_im2col
+    - needs_input_grad: If False, skip the gradient with respect to x, e.g.
+      for the first layer of a network, and return None for dx.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, or None
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param, x_cols = cache
+    N, C, H, W, F, HH, WW, stride, pad, layout = _conv_shapes(x, w, conv_param)
+    if x_cols is None:
+        x_cols = im2col(x, HH, WW, stride, pad, layout)
+
+    dx = None
+    if layout == "NHWC":
+        dout_mat = dout.reshape(-1, F)
+        db = dout_mat.sum(axis=0)
+        dw = x_cols.T.dot(dout_mat).reshape(HH, WW, C, F).transpose(3, 2, 0, 1)
+        dw = np.ascontiguousarray(dw)
+        if needs_input_grad:
+            dx_cols = dout_mat.dot(w.transpose(2, 3, 1, 0).reshape(-1, F).T)
+            dx = col2im(dx_cols, x.shape, HH, WW, stride, pad, layout)
+        return dx, dw, db
+
+    db = dout.sum(axis=(0, 2, 3))
+    dout_mat = dout.transpose(1, 0, 2, 3).reshape(F, -1)
+    dw = dout_mat.dot(x_cols.T).reshape(w.shape)
+    if needs_input_grad:
+        dx_cols = w.reshape(F, -1).T.dot(dout_mat)
+        dx = col2im(dx_cols, x.shape, HH, WW, stride, pad)
+    return dx, dw, db
+
+
+def _rfft(a, s, layout):
+    """rfft2 over the spatial axes of a, with frequencies first: (Hp, Wr, n, C)."""
+    if layout == "NHWC":
+        return np.fft.rfft2(a, s=s, axes=(1, 2)).transpose(1, 2, 0, 3)
+    return np.fft.rfft2(a, s=s).transpose(2, 3, 0, 1)
+
+
+def _irfft(a_f, s, layout):
+    """Inverse of _rfft."""
+    if layout == "NHWC":
+        return np.fft.irfft2(a_f.transpose(2, 0, 1, 3), s=s, axes=(1, 2))
+    return np.fft.irfft2(a_f.transpose(2, 3, 0, 1), s=s)
+
+
+def _spatial(layout, rows, cols):
+    """Index selecting rows and cols of the spatial axes of an array."""
+    if layout == "NHWC":
+        return (slice(None), rows, cols)
+    return (slice(None), slice(None), rows, cols)
+
+
+def conv_forward_fft(x, w, b, conv_param, chunk_size=16):
+    """
+    An implementation of the forward pass for a convolutional layer based on
+    the FFT. Its cost does not depend on the filter size, so it beats im2col
+    for large filters (7x7 and up) on large inputs.
+
+    The padded input and the filters are transformed with rfft2 at the size of
+    the padded input; at that size the circular correlation computed in the
+    frequency domain equals the ordinary one at every valid output position.
+    The sum over input channels is a batched matrix multiply per frequency.
+    Strided outputs are obtained by subsampling the stride-1 output.
+
+    Inputs are the same as for conv_forward_im2col, plus:
+    - chunk_size: Number of images transformed at once. The frequency-domain
+      buffers take O(chunk_size * (C + F) * H * W) memory.
+
+    Returns a tuple of:
+    - out: Output data, of shape (N, F, H', W'), or (N, H', W', F) for layout
+      'NHWC'
+    - cache: (x, w, b, conv_param, chunk_size)
+    """
+    N, C, H, W, F, HH, WW, stride, pad, layout = _conv_shapes(x, w, conv_param)
+    s = (H + 2 * pad, W + 2 * pad)
+    H_out = 1 + (s[0] - HH) // stride
+    W_out = 1 + (s[1] - WW) // stride
+    subsample = _spatial(
+        layout, slice(None, stride * H_out, stride), slice(None, stride * W_out, stride)
+    )
+
+    # Frequencies first, so that matmul batches over them: (Hp, Wr, C, F).
+    w_f = np.conj(np.fft.rfft2(w, s=s)).transpose(2, 3, 1, 0)
+    if layout == "NHWC":
+        out = np.empty((N, H_out, W_out, F), dtype=x.dtype)
+    else:
+        out = np.empty((N, F, H_out, W_out), dtype=x.dtype)
+    for start in range(0, N, chunk_size):
+        x_f = _rfft(_pad(x[start:start + chunk_size], pad, layout), s, layout)
+        y = _irfft(np.matmul(x_f, w_f), s, layout)
+        out[start:start + chunk_size] = y[subsample]
+    out += b if layout == "NHWC" else b.reshape(1, -1, 1, 1)
+
+    cache = (x, w, b, conv_param, chunk_size)
+    return out, cache
+
+
+def conv_backward_fft(dout, cache, needs_input_grad=True):
+    """
+    An implementation of the backward pass for a convolutional layer based on
+    the FFT.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, F, H', W'), or (N, H', W', F)
+      for layout 'NHWC'
+    - cache: A tuple of (x, w, b, conv_param, chunk_size) as in conv_forward_fft
+    - needs_input_grad: If False, skip the gradient with respect to x and
+      return None for dx.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, or None
+    - dw: Gradient with respect to w
+    - db: Gradient with respect to b
+    """
+    x, w, b, conv_param, chunk_size = cache
+    N, C, H, W, F, HH, WW, stride, pad, layout = _conv_shapes(x, w, conv_param)
+    s = (H + 2 * pad, W + 2 * pad)
+    H_out = 1 + (s[0] - HH) // stride
+    W_out = 1 + (s[1] - WW) // stride
+    subsample = _spatial(
+        layout, slice(None, stride * H_out, stride), slice(None, stride * W_out, stride)
+    )
+    unpad = _spatial(layout, slice(pad, pad + H), slice(pad, pad + W))
+
+    db = dout.sum(axis=(0, 1, 2) if layout == "NHWC" else (0, 2, 3))
+    w_f = np.fft.rfft2(w, s=s).transpose(2, 3, 0, 1)
+    dw_f = 0
+    dx = np.empty_like(x) if needs_input_grad else None
+    for start in range(0, N, chunk_size):
+        dout_chunk = dout[start:start + chunk_size]
+        n = dout_chunk.shape[0]
+        # Scatter dout back onto the positions of the stride-1 output.
+        if layout == "NHWC":
+            d = np.zeros((n,) + s + (F,), dtype=dout.dtype)
+        else:
+            d = np.zeros((n, F) + s, dtype=dout.dtype)
+        d[subsample] = dout_chunk
+        d_f = _rfft(d, s, layout)
+
+        # dw is the correlation of the input with dout, summed over images.
+        x_f = _rfft(_pad(x[start:start + chunk_size], pad, layout), s, layout)
+        dw_f = dw_f + np.matmul(np.conj(d_f).swapaxes(2, 3), x_f)
+
+        # dx is the convolution of dout with the filters, summed over filters.
+        if needs_input_grad:
+            dx[start:start + chunk_size] = _irfft(np.matmul(d_f, w_f), s, layout)[unpad]
+
+    dw = np.fft.irfft2(dw_f.transpose(2, 3, 0, 1), s=s)
+    dw = dw[:, :, :HH, :WW].astype(w.dtype)
+    return dx, dw, db
+
+
+def _conv_forward_naive(x, w, b, conv_param):
+    if conv_param.get("layout", "NCHW") == "NHWC":
+        out, cache = conv_forward_naive(x.transpose(0, 3, 1, 2), w, b, conv_param)
+        return out.transpose(0, 2, 3, 1), cache
+    return conv_forward_naive(x, w, b, conv_param)
+
+
+def _conv_backward_naive(dout, cache, needs_input_grad=True):
+    nhwc = cache[3].get("layout", "NCHW") == "NHWC"
+    if nhwc:
+        dout = dout.transpose(0, 3, 1, 2)
+    dx, dw, db = conv_backward_naive(dout, cache)
+    if nhwc:
+        dx = dx.transpose(0, 2, 3, 1)
+    return (dx if needs_input_grad else None), dw, db
+
+
+# Forward and backward functions of the convolution algorithms that
+# ConvAutotuner can choose from.
+CONV_ALGORITHMS = {
+    "naive": (_conv_forward_naive, _conv_backward_naive),
+    "im2col": (conv_forward_im2col, conv_backward_im2col),
+    "fft": (conv_forward_fft, conv_backward_fft),
+}
+
+
+class ConvAutotuner(object):
+    """
+    Picks the fastest convolution algorithm for every problem shape.
+
+    The first time forward() sees a signature (N, C, H, W, F, HH, WW, stride,
+    pad), plus the layout for channels-last inputs, it times a forward and a
+    backward pass of every candidate algorithm on the given inputs and records
+    the fastest one as the plan for that signature. All later calls with the
+    same signature dispatch to the plan directly. Plans are kept in memory
+    and, if cache_path is given, in a JSON file that is read when the
+    autotuner is created and rewritten whenever a new plan is added, so that
+    later runs skip the benchmarks.
+
+    Example usage:
+
+    tuner = ConvAutotuner(cache_path="conv_plans.json")
+    out, cache = tuner.forward(x, w, b, conv_param)
+    dx, dw, db = tuner.backward(dout, cache)
+    """
+
+    def __init__(self, candidates=("im2col", "fft"), cache_path=None, num_repeats=2):
+        """
+        Inputs:
+        - candidates: Names of algorithms in CONV_ALGORITHMS to choose from.
+          'naive' is left out by default since a single run of it can take
+          seconds on realistic shapes.
+        - cache_path: Optional path of a JSON file in which plans are stored.
+        - num_repeats: Each candidate is timed as the best of this many runs.
+        """
+        for name in candidates:
+            if name not in CONV_ALGORITHMS:
+                raise ValueError('Unrecognized convolution algorithm "%s"' % name)
+        self.candidates = tuple(candidates)
+        self.cache_path = cache_path
+        self.num_repeats = num_repeats
+        self.plans = {}
+        self.timings = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.plans = json.load(f)
+
+    @staticmethod
+    def signature(x, w, conv_param):
+        """Return the plan cache key of a convolution problem."""
+        N, C, H, W, F, HH, WW, stride, pad, layout = _conv_shapes(x, w, conv_param)
+        key = ",".join(str(d) for d in (N, C, H, W, F, HH, WW, stride, pad))
+        return key + ",NHWC" if layout == "NHWC" else key
+
+    def plan(self, x, w, b, conv_param):
+        """
+        Return the name of the algorithm to use for these inputs,
+        benchmarking the candidates if the signature has not been seen.
+        """
+        key = self.signature(x, w, conv_param)
+        if key not in self.plans:
+            timings = {}
+            for name in self.candidates:
+                forward, backward = CONV_ALGORITHMS[name]
+                best = float("inf")
+                for _ in range(self.num_repeats):
+                    tic = time.perf_counter()
+                    out, cache = forward(x, w, b, conv_param)
+                    backward(out, cache)
+                    best = min(best, time.perf_counter() - tic)
+                timings[name] = best
+            self.timings[key] = timings
+            self.plans[key] = min(timings, key=timings.get)
+            if self.cache_path is not None:
+                self._save()
+        return self.plans[key]
+
+    def _save(self):
+        # Write to a temporary file first so that a crash never leaves a
+        # truncated plan file behind.
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.plans, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def forward(self, x, w, b, conv_param):
+        """
+        Forward pass for a convolutional layer using the planned algorithm.
+
+        Inputs and outputs are the same as for conv_forward_naive, except that
+        the cache is (algorithm name, cache of that algorithm).
+        """
+        name = self.plan(x, w, b, conv_param)
+        out, cache = CONV_ALGORITHMS[name][0](x, w, b, conv_param)
+        return out, (name, cache)
+
+    def backward(self, dout, cache, needs_input_grad=True):
+        """
+        Backward pass for a convolutional layer, using the algorithm that ran
+        the forward pass.
+
+        Inputs:
+        - dout: Upstream derivatives, in the layout of the forward pass
+        - cache: The cache returned by forward()
+        - needs_input_grad: If False, return None for dx.
+
+        Returns a tuple of (dx, dw, db).
+        """
+        name, cache = cache
+        return CONV_ALGORITHMS[name][1](dout, cache, needs_input_grad)
+
+
+_default_autotuner = ConvAutotuner()
+
+
+def set_conv_autotuner(autotuner):
+    """
+    Replace the autotuner used by conv_forward_auto and conv_backward_auto,
+    e.g. by one with an on-disk plan cache.
+    """
+    global _default_autotuner
+    _default_autotuner = autotuner
+
+
+def conv_forward_auto(x, w, b, conv_param):
+    """Forward pass for a convolutional layer using the module autotuner."""
+    return _default_autotuner.forward(x, w, b, conv_param)
+
+
+def conv_backward_auto(dout, cache, needs_input_grad=True):
+    """Backward pass for a convolutional layer using the module autotuner."""
+    return _default_autotuner.backward(dout, cache, needs_input_grad)
+
+
+conv_forward_fast = conv_forward_im2col
+conv_backward_fast = conv_backward_im2col
+
+
+def _index_dtype(n):
+    """Return the smallest unsigned integer dtype that can index n elements."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.uint64
+
+
+def _pool_shapes(x_shape, pool_param):
+    """Return (N, C, H, W, ph, pw, stride, layout) of a pooling layer."""
+    layout = pool_param.get("layout", "NCHW")
+    if layout == "NHWC":
+        N, H, W, C = x_shape
+    else:
+        N, C, H, W = x_shape
+    ph, pw = pool_param["pool_height"], pool_param["pool_width"]
+    return N, C, H, W, ph, pw, pool_param["stride"], layout
+
+
+def max_pool_forward_reshape(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max-pooling layer whose
+    pooling regions tile the input exactly, i.e. pool_height == pool_width ==
+    stride and H and W are multiples of the pool size. The input is viewed as
+    (N, C, H / ph, ph, W / pw, pw) with a reshape, which copies only inputs
+    that are not contiguous; moving the entries of each window next to each
+    other then makes one copy of the input, after which the maximum is a
+    single reduction over the last axis.
+
+    Inputs and outputs are the same as for max_pool_forward_naive, except that
+    pool_param may contain a 'layout' key ('NCHW' or 'NHWC'), and that the
+    cache is (x.shape, pool_param, argmax), where argmax holds the position of
+    the maximum within each pooling region.
+    """
+    N, C, H, W, ph, pw, stride, layout = _pool_shapes(x.shape, pool_param)
+    if not (ph == pw == stride and H % ph == 0 and W % pw == 0):
+        raise ValueError("Pooling regions do not tile the input")
+    # Bring the window entries to the last axis: (..., ph * pw).
+    if layout == "NHWC":
+        x_windows = x.reshape(N, H // ph, ph, W // pw, pw, C).transpose(0, 1, 3, 5, 2, 4)
+        x_windows = x_windows.reshape(N, H // ph, W // pw, C, ph * pw)
+    else:
+        x_windows = x.reshape(N, C, H // ph, ph, W // pw, pw).transpose(0, 1, 2, 4, 3, 5)
+        x_windows = x_windows.reshape(N, C, H // ph, W // pw, ph * pw)
+    argmax = x_windows.argmax(axis=4)[..., None]
+    out = np.take_along_axis(x_windows, argmax, axis=4)[..., 0]
+    cache = (x.shape, pool_param, argmax.astype(_index_dtype(ph * pw)))
+    return out, cache
+
+
+def max_pool_backward_reshape(dout, cache):
+    """
+    A fast implementation of the backward pass for a max-pooling layer whose
+    pooling regions tile the input exactly.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C, H', W'), or (N, H', W', C)
+      for layout 'NHWC'
+    - cache: A tuple of (x.shape, pool_param, argmax) as in the forward pass
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x_shape, pool_param, argmax = cache
+    N, C, H, W, ph, pw, stride, layout = _pool_shapes(x_shape, pool_param)
+    dx_windows = np.zeros(dout.shape + (ph * pw,), dtype=dout.dtype)
+    np.put_along_axis(dx_windows, argmax.astype(np.intp), dout[..., None], axis=4)
+    dx_windows = dx_windows.reshape(dout.shape + (ph, pw))
+    if layout == "NHWC":
+        dx = dx_windows.transpose(0, 1, 4, 2, 5, 3)
+    else:
+        dx = dx_windows.transpose(0, 1, 2, 4, 3, 5)
+    return dx.reshape(x_shape)
+
+
+def max_pool_forward_strided(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max-pooling layer with
+    arbitrary pool sizes and stride, including overlapping regions, based on
+    a strided view of all pooling regions of x.
+
+    Inputs and outputs are the same as for max_pool_forward_reshape.
+    """
+    N, C, H, W, ph, pw, stride, layout = _pool_shapes(x.shape, pool_param)
+    windows = window_view(x, ph, pw, stride, layout)
+    if layout == "NHWC":
+        H_out, W_out = windows.shape[1:3]
+        windows = windows.transpose(0, 1, 2, 5, 3, 4).reshape(N, H_out, W_out, C, ph * pw)
+    else:
+        H_out, W_out = windows.shape[4:]
+        windows = windows.transpose(0, 1, 4, 5, 2, 3).reshape(N, C, H_out, W_out, ph * pw)
+    argmax = windows.argmax(axis=4)[..., None]
+    out = np.take_along_axis(windows, argmax, axis=4)[..., 0]
+    cache = (x.shape, pool_param, argmax.astype(_index_dtype(ph * pw)))
+    return out, cache
+
+
+def max_pool_backward_strided(dout, cache):
+    """
+    A fast implementation of the backward pass for a max-pooling layer with
+    arbitrary pool sizes and stride. Gradients of overlapping regions that
+    share a maximum are summed.
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, C, H', W'), or (N, H', W', C)
+      for layout 'NHWC'
+    - cache: A tuple of (x.shape, pool_param, argmax) as in the forward pass
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    x_shape, pool_param, argmax = cache
+    N, C, H, W, ph, pw, stride, layout = _pool_shapes(x_shape, pool_param)
+    argmax = argmax[..., 0].astype(np.intp)
+
+    # Flat index into x of the maximum of every pooling region.
+    if layout == "NHWC":
+        H_out, W_out = dout.shape[1:3]
+        rows = stride * np.arange(H_out).reshape(-1, 1, 1) + argmax // pw
+        cols = stride * np.arange(W_out).reshape(-1, 1) + argmax % pw
+        images = np.arange(N).reshape(N, 1, 1, 1)
+        index = ((images * H + rows) * W + cols) * C + np.arange(C)
+    else:
+        H_out, W_out = dout.shape[2:]
+        rows = stride * np.arange(H_out).reshape(-1, 1) + argmax // pw
+        cols = stride * np.arange(W_out) + argmax % pw
+        planes = np.arange(N * C).reshape(N, C, 1, 1)
+        index = (planes * H + rows) * W + cols
+    dx = np.bincount(index.ravel(), weights=dout.ravel(), minlength=N * C * H * W)
+    return dx.reshape(x_shape).astype(dout.dtype, copy=False)
+
+
+def max_pool_forward_fast(x, pool_param):
+    """
+    A fast implementation of the forward pass for a max-pooling layer. It uses
+    the reshape method when the pooling regions tile the input and the
+    strided method otherwise.
+
+    Inputs and outputs are the same as for max_pool_forward_naive, except that
+    pool_param may contain a 'layout' key ('NCHW' or 'NHWC'), and that the
+    cache is (method, cache of that method).
+    """
+    N, C, H, W, ph, pw, stride, layout = _pool_shapes(x.shape, pool_param)
+    if ph == pw == stride and H % ph == 0 and W % pw == 0:
+        out, cache = max_pool_forward_reshape(x, pool_param)
+        return out, ("reshape", cache)
+    out, cache = max_pool_forward_strided(x, pool_param)
+    return out, ("strided", cache)
+
+
+def max_pool_backward_fast(dout, cache):
+    """
+    A fast implementation of the backward pass for a max-pooling layer.
+
+    Inputs:
+    - dout: Upstream derivatives
+    - cache: A tuple of (method, cache) as in max_pool_forward_fast
+
+    Returns:
+    - dx: Gradient with respect to x
+    """
+    method, cache = cache
+    if method == "reshape":
+        return max_pool_backward_reshape(dout, cache)
+    return max_pool_backward_strided(dout, cache)
@@ -0,0 +1,128 @@
+from builtins import range
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+"""
+Helpers that turn a convolution into a single matrix multiply.
+
+im2col unfolds every receptive field of a padded input into one column of a
+matrix, so that convolving with F filters becomes a (F, C*HH*WW) by
+(C*HH*WW, N*H'*W') product. col2im is its adjoint: it sums the columns back
+into the positions of the padded input they were read from, which is how the
+gradient with respect to the input is computed.
+
+All helpers accept a layout argument. For channels-first data ('NCHW') the
+receptive fields are the columns of the matrix, as described above; for
+channels-last data ('NHWC') they are its rows, so that the matrix of shape
+(N*H'*W', HH*WW*C) times the filters gives the output directly in the
+(N, H', W', F) layout.
+"""
+
+
+def _pad(x, pad, layout):
+    if layout == "NHWC":
+        pad_width = ((0, 0), (pad, pad), (pad, pad), (0, 0))
+    else:
+        pad_width = ((0, 0), (0, 0), (pad, pad), (pad, pad))
+    return np.pad(x, pad_width, mode="constant")
+
+
+def window_view(x_padded, HH, WW, stride, layout="NCHW"):
+    """
+    Return a read-only strided view of all receptive fields of x_padded,
+    without copying any data.
+
+    Inputs:
+    - x_padded: Array of shape (N, C, H, W), or (N, H, W, C) for layout 'NHWC'
+    - HH, WW: Height and width of the receptive fields
+    - stride: Distance between adjacent receptive fields
+    - layout: 'NCHW' or 'NHWC'
+
+    Returns:
+    - windows: View of shape (N, C, HH, WW, H', W') with
+      windows[n, c, i, j, y, x] = x_padded[n, c, y * stride + i, x * stride + j],
+      or for layout 'NHWC' of shape (N, H', W', HH, WW, C) with
+      windows[n, y, x, i, j, c] = x_padded[n, y * stride + i, x * stride + j, c]
+    """
+    if layout == "NHWC":
+        N, H, W, C = x_padded.shape
+        sN, sH, sW, sC = x_padded.strides
+    else:
+        N, C, H, W = x_padded.shape
+        sN, sC, sH, sW = x_padded.strides
+    H_out = 1 + (H - HH) // stride
+    W_out = 1 + (W - WW) // stride
+    if layout == "NHWC":
+        shape = (N, H_out, W_out, HH, WW, C)
+        strides = (sN, stride * sH, stride * sW, sH, sW, sC)
+    else:
+        shape = (N, C, HH, WW, H_out, W_out)
+        strides = (sN, sC, sH, sW, stride * sH, stride * sW)
+    return as_strided(x_padded, shape=shape, strides=strides, writeable=False)
+
+
+def im2col(x, HH, WW, stride, pad, layout="NCHW"):
+    """
+    Unfold the receptive fields of x into the columns of a matrix.
+
+    Inputs:
+    - x: Input data of shape (N, C, H, W), or (N, H, W, C) for layout 'NHWC'
+    - HH, WW: Filter height and width
+    - stride, pad: As in conv_forward_naive
+    - layout: 'NCHW' or 'NHWC'
+
+    Returns:
+    - cols: Array of shape (C * HH * WW, N * H' * W'); the rows are ordered
+      like the entries of a filter w[f] of shape (C, HH, WW), and the columns
+      like the entries of an output map of shape (N, H', W'). For layout
+      'NHWC' the array has shape (N * H' * W', HH * WW * C) instead, and
+      each row is a receptive field in (HH, WW, C) order.
+    """
+    windows = window_view(_pad(x, pad, layout), HH, WW, stride, layout)
+    # The reshape copies the windows into a contiguous matrix.
+    if layout == "NHWC":
+        N, H_out, W_out, _, _, C = windows.shape
+        return windows.reshape(N * H_out * W_out, HH * WW * C)
+    N, C = windows.shape[:2]
+    H_out, W_out = windows.shape[4:]
+    return windows.transpose(1, 2, 3, 0, 4, 5).reshape(C * HH * WW, N * H_out * W_out)
+
+
+def col2im(cols, x_shape, HH, WW, stride, pad, layout="NCHW"):
+    """
+    Sum the columns of a matrix laid out as the output of im2col back into an
+    array of the shape of x. Overlapping receptive fields accumulate.
+
+    Inputs:
+    - cols: Array of the shape returned by im2col
+    - x_shape: Shape of the input given to im2col
+    - HH, WW, stride, pad, layout: As given to im2col
+
+    Returns:
+    - x: Array of shape x_shape
+    """
+    if layout == "NHWC":
+        N, H, W, C = x_shape
+    else:
+        N, C, H, W = x_shape
+    H_out = 1 + (H + 2 * pad - HH) // stride
+    W_out = 1 + (W + 2 * pad - WW) // stride
+    # Each filter offset (i, j) writes to a strided grid of positions without
+    # overlap, so the loop only runs over the HH * WW offsets.
+    if layout == "NHWC":
+        cols = cols.reshape(N, H_out, W_out, HH, WW, C)
+        x_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=cols.dtype)
+        for i in range(HH):
+            for j in range(WW):
+                x_padded[
+                    :, i:i + stride * H_out:stride, j:j + stride * W_out:stride
+                ] += cols[:, :, :, i, j]
+        return x_padded[:, pad:pad + H, pad:pad + W]
+    cols = cols.reshape(C, HH, WW, N, H_out, W_out)
+    x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+    for i in range(HH):
+        for j in range(WW):
+            x_padded[
+                :, :, i:i + stride * H_out:stride, j:j + stride * W_out:stride
+            ] += cols[:, i, j].transpose(1, 0, 2, 3)
+    return x_padded[:, :, pad:pad + H, pad:pad + W]
@@ -19,12 +19,113 @@ def affine_relu_forward(x, w, b):
     return out, cache
 
 
-def affine_relu_backward(dout, cache):
+def affine_relu_backward(dout, cache, needs_input_grad=True):
     """
-    Backward pass for the affine-relu convenience layer
+    Backward pass for the affine-relu convenience layer. If needs_input_grad
+    is False, dx is not computed and None is returned in its place.
     """
     fc_cache, relu_cache = cache
     da = relu_backward(dout, relu_cache)
-    dx, dw, db = affine_backward(da, fc_cache)
+    dx, dw, db = affine_backward(da, fc_cache, needs_input_grad)
     return dx, dw, db
 
+
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+    """
+    Convenience layer that performs an affine transform followed by batch
+    normalization and a ReLU
+
+    Inputs:
+    - x: Input to the affine layer
+    - w, b: Weights for the affine layer
+    - gamma, beta: Scale and shift parameters for the batchnorm layer
+    - bn_param: Dictionary of parameters for the batchnorm layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: Object to give to the backward pass
+    """
+    a, fc_cache = affine_forward(x, w, b)
+    bn, bn_cache = batchnorm_forward_fused(a, gamma, beta, bn_param)
+    out, relu_cache = relu_forward(bn)
+    cache = (fc_cache, bn_cache, relu_cache)
+    return out, cache
+
+
+def affine_bn_relu_backward(dout, cache, needs_input_grad=True):
+    """
+    Backward pass for the affine-batchnorm-relu convenience layer. If
+    needs_input_grad is False, dx is not computed and None is returned in its
+    place.
+    """
+    fc_cache, bn_cache, relu_cache = cache
+    da = relu_backward(dout, relu_cache)
+    dbn, dgamma, dbeta = batchnorm_backward_fused(da, bn_cache)
+    dx, dw, db = affine_backward(dbn, fc_cache, needs_input_grad)
+    return dx, dw, db, dgamma, dbeta
+
+
+def affine_ln_relu_forward(x, w, b, gamma, beta, ln_param):
+    """
+    Convenience layer that performs an affine transform followed by layer
+    normalization and a ReLU
+
+    Inputs:
+    - x: Input to the affine layer
+    - w, b: Weights for the affine layer
+    - gamma, beta: Scale and shift parameters for the layernorm layer
+    - ln_param: Dictionary of parameters for the layernorm layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: Object to give to the backward pass
+    """
+    a, fc_cache = affine_forward(x, w, b)
+    ln, ln_cache = layernorm_forward(a, gamma, beta, ln_param)
+    out, relu_cache = relu_forward(ln)
+    cache = (fc_cache, ln_cache, relu_cache)
+    return out, cache
+
+
+def affine_ln_relu_backward(dout, cache, needs_input_grad=True):
+    """
+    Backward pass for the affine-layernorm-relu convenience layer. If
+    needs_input_grad is False, dx is not computed and None is returned in its
+    place.
+    """
+    fc_cache, ln_cache, relu_cache = cache
+    da = relu_backward(dout, relu_cache)
+    dln, dgamma, dbeta = layernorm_backward(da, ln_cache)
+    dx, dw, db = affine_backward(dln, fc_cache, needs_input_grad)
+    return dx, dw, db, dgamma, dbeta
+
+
+def lowrank_affine_relu_forward(x, u, v, b):
+    """
+    Convenience layer that performs a rank-r factorized affine transform
+    followed by a ReLU
+
+    Inputs:
+    - x: Input to the affine layer
+    - u, v, b: Weight factors and biases for the factorized affine layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: Object to give to the backward pass
+    """
+    a, fc_cache = lowrank_affine_forward(x, u, v, b)
+    out, relu_cache = relu_forward(a)
+    cache = (fc_cache, relu_cache)
+    return out, cache
+
+
+def lowrank_affine_relu_backward(dout, cache, needs_input_grad=True):
+    """
+    Backward pass for the factorized affine-relu convenience layer. If
+    needs_input_grad is False, dx is not computed and None is returned in its
+    place.
+    """
+    fc_cache, relu_cache = cache
+    da = relu_backward(dout, relu_cache)
+    dx, du, dv, db = lowrank_affine_backward(da, fc_cache, needs_input_grad)
+    return dx, du, dv, db
@@ -1,6 +1,63 @@
 from builtins import range
 import numpy as np
 
+# When True, layers that support it store only what their backward pass needs
+# in their caches, e.g. a boolean mask instead of the input of a ReLU, at the
+# price of some recomputation. Change it with set_lean_caches.
+_lean_caches = False
+
+
+def set_lean_caches(enabled):
+    """
+    Turn the memory-lean cache mode of the layers on or off and return the
+    previous setting. The backward passes accept caches of either mode, so
+    the setting only affects forward passes run after the call.
+    """
+    global _lean_caches
+    previous = _lean_caches
+    _lean_caches = bool(enabled)
+    return previous
+
+
+def lean_caches_enabled():
+    """Return True if the memory-lean cache mode is on."""
+    return _lean_caches
+
+
+def cache_nbytes(cache, seen=None):
+    """
+    Return the number of bytes of the arrays held by a layer cache, which may
+    be an array or a nested tuple, list or dict of arrays. Arrays that share
+    memory are counted once.
+
+    Inputs:
+    - cache: A cache returned by a forward pass
+    - seen: Optional set of ids of the memory buffers already counted, e.g.
+      those of the model parameters, which are not counted and to which the
+      buffers of cache are added. Pass the same set to several calls to avoid
+      counting arrays shared between caches twice. Since ids are only unique
+      among live objects, the caches must be kept alive while seen is used.
+
+    Returns:
+    - nbytes: Integer number of bytes
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(cache, np.ndarray):
+        root = cache
+        while isinstance(root.base, np.ndarray):
+            root = root.base
+        if id(root) in seen:
+            return 0
+        seen.add(id(root))
+        return root.nbytes
+    if isinstance(cache, dict):
+        cache = list(cache.values())
+    if isinstance(cache, (tuple, list)):
+        return sum(cache_nbytes(c, seen) for c in cache)
+    return 0
+
+
 def affine_forward(x, w, b):
     """
     Computes the forward pass for an affine (fully-connected) layer.
@@ -35,7 +92,7 @@ def affine_forward(x, w, b):
     return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, needs_input_grad=True):
     """
     Computes the backward pass for an affine layer.
 
@@ -45,9 +102,12 @@ def affine_backward(dout, cache):
       - x: Input data, of shape (N, d_1, ... d_k)
       - w: Weights, of shape (D, M)
       - b: Biases, of shape (M,)
+    - needs_input_grad: If False, the gradient with respect to x is neither
+      computed nor allocated and dx is returned as None. Use this for the first
+      layer of a network, where nothing consumes the gradient of the raw input.
 
     Returns a tuple of:
-    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k), or None
     - dw: Gradient with respect to w, of shape (D, M)
     - db: Gradient with respect to b, of shape (M,)
     """
@@ -62,8 +122,9 @@ def affine_backward(dout, cache):
 
     dw = x_reshaped.T.dot(dout) 
 
-    dx_reshaped = dout.dot(w.T) 
-    dx = dx_reshaped.reshape(x.shape) 
+    if needs_input_grad:
+        dx_reshaped = dout.dot(w.T) 
+        dx = dx_reshaped.reshape(x.shape) 
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -79,7 +140,7 @@ def relu_forward(x):
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: x, or the boolean mask x > 0 in lean cache mode
     """
     out = None
     ###########################################################################
@@ -89,7 +150,7 @@ def relu_forward(x):
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
-    cache = x
+    cache = x > 0 if _lean_caches else x
     return out, cache
 
 
@@ -99,7 +160,7 @@ def relu_backward(dout, cache):
 
     Input:
     - dout: Upstream derivatives, of any shape
-    - cache: Input x, of same shape as dout
+    - cache: Input x, or the boolean mask x > 0, of same shape as dout
 
     Returns:
     - dx: Gradient with respect to x
@@ -108,7 +169,7 @@ def relu_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
-    mask = (x > 0)
+    mask = x if x.dtype == bool else (x > 0)
     dx = dout * mask
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -315,6 +376,85 @@ def batchnorm_backward_alt(dout, cache):
     return dx, dgamma, dbeta
 
 
+def batchnorm_forward_fused(x, gamma, beta, bn_param):
+    """
+    Fused forward pass for batch normalization.
+
+    Takes the same inputs as batchnorm_forward and returns the same output,
+    but avoids the temporaries of the textbook formulation: the input is
+    centered once into the buffer that becomes x_hat, the variance is a
+    single reduction over that buffer, and the normalization, scaling and
+    shift are applied in place. The cache holds only x_hat and the inverse
+    standard deviation, instead of x, x_normalized and the statistics.
+
+    Inputs / outputs: Same as batchnorm_forward, except that the cache is
+    (x_hat, inv_std, gamma) and is None at test time.
+    """
+    mode = bn_param["mode"]
+    eps = bn_param.get("eps", 1e-5)
+    momentum = bn_param.get("momentum", 0.9)
+
+    N, D = x.shape
+    running_mean = bn_param.get("running_mean", np.zeros(D, dtype=x.dtype))
+    running_var = bn_param.get("running_var", np.zeros(D, dtype=x.dtype))
+
+    cache = None
+    if mode == "train":
+        sample_mean = x.mean(axis=0)
+        x_hat = np.subtract(x, sample_mean)
+        # Variance of the centered data, as one reduction without a temporary.
+        sample_var = np.einsum("ij,ij->j", x_hat, x_hat) / N
+        inv_std = 1.0 / np.sqrt(sample_var + eps)
+        x_hat *= inv_std
+        out = np.multiply(x_hat, gamma)
+        out += beta
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+        running_var = momentum * running_var + (1 - momentum) * sample_var
+        cache = (x_hat, inv_std, gamma)
+    elif mode == "test":
+        # Fold the running statistics into a single scale and shift.
+        scale = gamma / np.sqrt(running_var + eps)
+        out = np.multiply(x, scale)
+        out += beta - running_mean * scale
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+
+    bn_param["running_mean"] = running_mean
+    bn_param["running_var"] = running_var
+
+    return out, cache
+
+
+def batchnorm_backward_fused(dout, cache):
+    """
+    Fused backward pass for batch normalization, using the closed form
+
+    dx = gamma * inv_std * (dout - mean(dout) - x_hat * mean(dout * x_hat))
+
+    where both means are the reductions that also give dbeta and dgamma. dx is
+    built in a single output buffer without temporaries of shape (N, D).
+
+    Inputs:
+    - dout: Upstream derivatives, of shape (N, D)
+    - cache: Variable of intermediates from batchnorm_forward_fused.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to inputs x, of shape (N, D)
+    - dgamma: Gradient with respect to scale parameter gamma, of shape (D,)
+    - dbeta: Gradient with respect to shift parameter beta, of shape (D,)
+    """
+    x_hat, inv_std, gamma = cache
+    N = dout.shape[0]
+
+    dbeta = dout.sum(axis=0)
+    dgamma = np.einsum("ij,ij->j", dout, x_hat)
+
+    dx = np.multiply(x_hat, -dgamma / N)
+    dx += dout
+    dx -= dbeta / N
+    dx *= gamma * inv_std
+    return dx, dgamma, dbeta
+
 def layernorm_forward(x, gamma, beta, ln_param):
     """
     Forward pass for layer normalization.
@@ -335,7 +475,8 @@ def layernorm_forward(x, gamma, beta, ln_param):
 
     Returns a tuple of:
     - out: of shape (N, D)
-    - cache: A tuple of values needed in the backward pass
+    - cache: A tuple of values needed in the backward pass. In lean cache mode
+      it is (x_normalized, inv_std, gamma) and does not hold x.
     """
     out, cache = None, None
     eps = ln_param.get("eps", 1e-5)
@@ -362,7 +503,10 @@ def layernorm_forward(x, gamma, beta, ln_param):
     out = gamma * x_normalized + beta
 
     # Store intermediates in cache
-    cache = (x, mu, var, x_normalized, gamma, beta, eps)
+    if _lean_caches:
+        cache = (x_normalized, 1.0 / np.sqrt(var + eps), gamma)
+    else:
+        cache = (x, mu, var, x_normalized, gamma, beta, eps)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -393,6 +537,19 @@ def layernorm_backward(dout, cache):
     # implementation of batch normalization. The hints to the forward pass    #
     # still apply!                                                            #
     ###########################################################################
+    if len(cache) == 3:
+        # Lean cache: use the closed form, which only needs x_normalized.
+        x_normalized, inv_std, gamma = cache
+        dbeta = np.sum(dout, axis=0)
+        dgamma = np.sum(dout * x_normalized, axis=0)
+        dx_normalized = dout * gamma
+        dx = inv_std * (
+            dx_normalized
+            - np.mean(dx_normalized, axis=1, keepdims=True)
+            - x_normalized * np.mean(dx_normalized * x_normalized, axis=1, keepdims=True)
+        )
+        return dx, dgamma, dbeta
+
     x, mu, var, x_normalized, gamma, beta, eps = cache
     N, D = x.shape
 
@@ -429,12 +586,18 @@ def dropout_forward(x, dropout_param):
         if the mode is test, then just return the input.
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
-        in real networks.
+        in real networks. The mask is drawn from a new np.random.Generator
+        seeded with it, so the global np.random state is left untouched.
+      - rng: Optional np.random.Generator to draw the mask from when no seed
+        is given, e.g. one stream per layer. Defaults to the global np.random.
 
     Outputs:
     - out: Array of the same shape as x.
     - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
-      mask that was used to multiply the input; in test mode, mask is None.
+      mask that was used to multiply the input, stored as a tuple (bits,
+      shape) of the np.packbits-packed keep mask and its shape; this takes
+      1/8 of a byte per entry instead of a full float. In test mode, mask is
+      None.
 
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -445,7 +608,9 @@ def dropout_forward(x, dropout_param):
     """
     p, mode = dropout_param["p"], dropout_param["mode"]
     if "seed" in dropout_param:
-        np.random.seed(dropout_param["seed"])
+        rng = np.random.default_rng(dropout_param["seed"])
+    else:
+        rng = dropout_param.get("rng", np.random)
 
     mask = None
     out = None
@@ -455,8 +620,10 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.rand(*x.shape) < p) / p  # Inverted dropout mask
-        out = x * mask  # Apply the mask
+        keep = rng.random(x.shape) < p
+        out = x * keep  # Apply the mask
+        out *= 1.0 / p  # Inverted dropout scaling
+        mask = (np.packbits(keep, axis=None), keep.shape)
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -491,7 +658,10 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = dout * mask  # Apply the same mask to the upstream gradient
+        bits, shape = mask
+        keep = np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).view(bool)
+        dx = dout * keep  # Apply the same mask to the upstream gradient
+        dx *= 1.0 / dropout_param["p"]
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
@@ -626,7 +796,7 @@ def conv_backward_naive(dout, cache):
                     db[f] += dout[n, f, i, j]
 
     # Unpad the gradient with respect to the input
-    dx = dx_padded[:, :, pad:-pad, pad:-pad]
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -751,11 +921,14 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     Computes the forward pass for spatial batch normalization.
 
     Inputs:
-    - x: Input data of shape (N, C, H, W)
+    - x: Input data of shape (N, C, H, W), or (N, H, W, C) for layout 'NHWC'
     - gamma: Scale parameter, of shape (C,)
     - beta: Shift parameter, of shape (C,)
     - bn_param: Dictionary with the following keys:
       - mode: 'train' or 'test'; required
+      - layout: 'NCHW' (default) or 'NHWC'. In the channels-last layout the
+        data is normalized in place of a (N * H * W, C) view of x, without
+        transposing it.
       - eps: Constant for numeric stability
       - momentum: Constant for running mean / variance. momentum=0 means that
         old information is discarded completely at every time step, while
@@ -765,7 +938,7 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
       - running_var Array of shape (D,) giving running variance of features
 
     Returns a tuple of:
-    - out: Output data, of shape (N, C, H, W)
+    - out: Output data, of the same shape as x
     - cache: Values needed for the backward pass
     """
     out, cache = None, None
@@ -777,10 +950,19 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     # vanilla version of batch normalization you implemented above.           #
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
-    N, C, H, W = x.shape
-    x_reshaped = x.transpose(0, 2, 3, 1).reshape(-1, C)  # Reshape to (N*H*W, C)
-    out_reshaped, cache = batchnorm_forward(x_reshaped, gamma, beta, bn_param)
-    out = out_reshaped.reshape(N, H, W, C).transpose(0, 3, 1, 2)  # Reshape back to (N, C, H, W)
+    layout = bn_param.get("layout", "NCHW")
+    # In lean cache mode, use the fused kernel, which caches only x_hat.
+    forward = batchnorm_forward_fused if _lean_caches else batchnorm_forward
+    if layout == "NHWC":
+        C = x.shape[3]
+        out, cache = forward(x.reshape(-1, C), gamma, beta, bn_param)
+        out = out.reshape(x.shape)
+    else:
+        N, C, H, W = x.shape
+        x_reshaped = x.transpose(0, 2, 3, 1).reshape(-1, C)  # Reshape to (N*H*W, C)
+        out_reshaped, cache = forward(x_reshaped, gamma, beta, bn_param)
+        out = out_reshaped.reshape(N, H, W, C).transpose(0, 3, 1, 2)  # Reshape back to (N, C, H, W)
+    cache = (cache, layout, _lean_caches)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -793,11 +975,11 @@ def spatial_batchnorm_backward(dout, cache):
     Computes the backward pass for spatial batch normalization.
 
     Inputs:
-    - dout: Upstream derivatives, of shape (N, C, H, W)
+    - dout: Upstream derivatives, in the layout of the forward pass
     - cache: Values from the forward pass
 
     Returns a tuple of:
-    - dx: Gradient with respect to inputs, of shape (N, C, H, W)
+    - dx: Gradient with respect to inputs, of the same shape as dout
     - dgamma: Gradient with respect to scale parameter, of shape (C,)
     - dbeta: Gradient with respect to shift parameter, of shape (C,)
     """
@@ -810,10 +992,17 @@ def spatial_batchnorm_backward(dout, cache):
     # vanilla version of batch normalization you implemented above.           #
     # Your implementation should be very short; ours is less than five lines. #
     ###########################################################################
-    N, C, H, W = dout.shape
-    dout_reshaped = dout.transpose(0, 2, 3, 1).reshape(-1, C)  # Reshape to (N*H*W, C)
-    dx_reshaped, dgamma, dbeta = batchnorm_backward(dout_reshaped, cache)
-    dx = dx_reshaped.reshape(N, H, W, C).transpose(0, 3, 1, 2)  # Reshape back to (N, C, H, W)
+    cache, layout, fused = cache
+    backward = batchnorm_backward_fused if fused else batchnorm_backward
+    if layout == "NHWC":
+        C = dout.shape[3]
+        dx, dgamma, dbeta = backward(dout.reshape(-1, C), cache)
+        dx = dx.reshape(dout.shape)
+    else:
+        N, C, H, W = dout.shape
+        dout_reshaped = dout.transpose(0, 2, 3, 1).reshape(-1, C)  # Reshape to (N*H*W, C)
+        dx_reshaped, dgamma, dbeta = backward(dout_reshaped, cache)
+        dx = dx_reshaped.reshape(N, H, W, C).transpose(0, 3, 1, 2)  # Reshape back to (N, C, H, W)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -821,6 +1010,18 @@ def spatial_batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
+def _group_view(x, G, layout):
+    """
+    Return a view of x in which the elements of every group of channels can
+    be reduced over, along with the axes to reduce.
+    """
+    if layout == "NHWC":
+        N, H, W, C = x.shape
+        return x.reshape(N, H * W, G, C // G), (1, 3)
+    N, C, H, W = x.shape
+    return x.reshape(N, G, -1), (2,)
+
+
 def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     """
     Computes the forward pass for spatial group normalization.
@@ -829,15 +1030,17 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     Per feature shifting and scaling are then applied to the data, in a manner identical to that of batch normalization and layer normalization.
 
     Inputs:
-    - x: Input data of shape (N, C, H, W)
-    - gamma: Scale parameter, of shape (1, C, 1, 1)
-    - beta: Shift parameter, of shape (1, C, 1, 1)
+    - x: Input data of shape (N, C, H, W), or (N, H, W, C) for layout 'NHWC'
+    - gamma: Scale parameter, of shape (1, C, 1, 1), or (1, 1, 1, C) for
+      layout 'NHWC'
+    - beta: Shift parameter, of the same shape as gamma
     - G: Integer mumber of groups to split into, should be a divisor of C
     - gn_param: Dictionary with the following keys:
       - eps: Constant for numeric stability
+      - layout: 'NCHW' (default) or 'NHWC'
 
     Returns a tuple of:
-    - out: Output data, of shape (N, C, H, W)
+    - out: Output data, of the same shape as x
     - cache: Values needed for the backward pass
     """
     out, cache = None, None
@@ -849,24 +1052,22 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     # the bulk of the code is similar to both train-time batch normalization  #
     # and layer normalization!                                                #
     ###########################################################################
-    N, C, H, W = x.shape
-    x = x.reshape(N, G, C // G, H, W)
+    layout = gn_param.get("layout", "NCHW")
+    x_groups, axes = _group_view(x, G, layout)
 
     # Compute mean and variance for each group
-    mean = np.mean(x, axis=(2, 3, 4), keepdims=True)
-    var = np.var(x, axis=(2, 3, 4), keepdims=True)
-
-    # Normalize the data
-    x_normalized = (x - mean) / np.sqrt(var + eps)
+    mean = np.mean(x_groups, axis=axes, keepdims=True)
+    var = np.var(x_groups, axis=axes, keepdims=True)
+    inv_std = 1.0 / np.sqrt(var + eps)
 
-    # Reshape back to original shape
-    x_normalized = x_normalized.reshape(N, C, H, W)
+    # Normalize the data and reshape back to original shape
+    x_normalized = ((x_groups - mean) * inv_std).reshape(x.shape)
 
     # Scale and shift
     out = gamma * x_normalized + beta
 
     # Store intermediates in cache
-    cache = (x, mean, var, x_normalized, gamma, beta, G, eps)
+    cache = (x_normalized, inv_std, gamma, G, layout)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -878,13 +1079,13 @@ def spatial_groupnorm_backward(dout, cache):
     Computes the backward pass for spatial group normalization.
 
     Inputs:
-    - dout: Upstream derivatives, of shape (N, C, H, W)
+    - dout: Upstream derivatives, in the layout of the forward pass
     - cache: Values from the forward pass
 
     Returns a tuple of:
-    - dx: Gradient with respect to inputs, of shape (N, C, H, W)
-    - dgamma: Gradient with respect to scale parameter, of shape (1, C, 1, 1)
-    - dbeta: Gradient with respect to shift parameter, of shape (1, C, 1, 1)
+    - dx: Gradient with respect to inputs, of the same shape as dout
+    - dgamma: Gradient with respect to scale parameter, of the shape of gamma
+    - dbeta: Gradient with respect to shift parameter, of the shape of gamma
     """
     dx, dgamma, dbeta = None, None, None
 
@@ -892,35 +1093,118 @@ def spatial_groupnorm_backward(dout, cache):
     # TODO: Implement the backward pass for spatial group normalization.      #
     # This will be extremely similar to the layer norm implementation.        #
     ###########################################################################
-    x, mean, var, x_normalized, gamma, beta, G, eps = cache
-    N, C, H, W = dout.shape
-
-    # Reshape dout to match the shape of x_normalized
-    dout = dout.reshape(N, G, C // G, H, W)
-
-    # Compute gradients
-    dbeta = np.sum(dout, axis=(0, 2, 3, 4), keepdims=True)
-    dgamma = np.sum(dout * x_normalized, axis=(0, 2, 3, 4), keepdims=True)
+    x_normalized, inv_std, gamma, G, layout = cache
 
-    dx_normalized = dout * gamma
-
-    # Reshape x_normalized to match the shape of x
-    x_normalized = x_normalized.reshape(N, G, C // G, H, W)
+    # Compute gradients for gamma and beta, summing over all but the channels
+    param_axes = tuple(i for i in range(4) if gamma.shape[i] == 1)
+    dbeta = np.sum(dout, axis=param_axes, keepdims=True)
+    dgamma = np.sum(dout * x_normalized, axis=param_axes, keepdims=True)
 
-    # Compute gradients for x
-    dvar = np.sum(dx_normalized * (x - mean), axis=(2, 3, 4), keepdims=True) * (-0.5) * (var + eps)**(-1.5)
-    dmean = np.sum(dx_normalized, axis=(2, 3, 4), keepdims=True) * (-1 / np.sqrt(var + eps)) + dvar * (-2) * np.mean(x - mean, axis=(2, 3, 4), keepdims=True)
-
-    dx = dx_normalized / np.sqrt(var + eps) + dvar * (2 * (x - mean) / (C // G * H * W)) + dmean / (C // G * H * W)
+    # Compute gradients for x, per group
+    dx_normalized, axes = _group_view(dout * gamma, G, layout)
+    x_normalized, _ = _group_view(x_normalized, G, layout)
+    dx = inv_std * (
+        dx_normalized
+        - np.mean(dx_normalized, axis=axes, keepdims=True)
+        - x_normalized * np.mean(dx_normalized * x_normalized, axis=axes, keepdims=True)
+    )
 
     # Reshape dx back to original shape
-    dx = dx.reshape(N, C, H, W)
+    dx = dx.reshape(dout.shape)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx, dgamma, dbeta
 
 
+def _channel_sums(a, b, layout):
+    """Return the sums over H and W of a * b (or of a if b is None), of shape (N, C)."""
+    spec = "nhwc" if layout == "NHWC" else "nchw"
+    if b is None:
+        return np.einsum(spec + "->nc", a)
+    return np.einsum(spec + "," + spec + "->nc", a, b)
+
+
+def _per_channel(v, layout):
+    """Reshape an array of shape (N, C) to broadcast against x in the given layout."""
+    N, C = v.shape
+    return v.reshape(N, 1, 1, C) if layout == "NHWC" else v.reshape(N, C, 1, 1)
+
+
+def spatial_groupnorm_forward_fused(x, gamma, beta, G, gn_param):
+    """
+    Fused forward pass for spatial group normalization.
+
+    Takes the same inputs as spatial_groupnorm_forward and returns the same
+    output. The group statistics are computed from per-channel sums of shape
+    (N, C), which are then summed over the C // G channels of each group, so
+    x is never reshaped or transposed and both layouts reduce over their
+    contiguous axes. x is centered once into the buffer that becomes x_hat,
+    and the normalization, scaling and shift are applied in place.
+
+    Inputs / outputs: Same as spatial_groupnorm_forward, except that the cache
+    is (x_hat, inv_std, gamma, G, layout), where inv_std has shape (N, G).
+    """
+    eps = gn_param.get("eps", 1e-5)
+    layout = gn_param.get("layout", "NCHW")
+    N = x.shape[0]
+    C = x.shape[3] if layout == "NHWC" else x.shape[1]
+    group_size = x.size // (N * G)
+
+    mean = _channel_sums(x, None, layout).reshape(N, G, -1).sum(axis=2) / group_size
+    x_hat = np.subtract(x, _per_channel(np.repeat(mean, C // G, axis=1), layout))
+    var = _channel_sums(x_hat, x_hat, layout).reshape(N, G, -1).sum(axis=2) / group_size
+    inv_std = 1.0 / np.sqrt(var + eps)
+    x_hat *= _per_channel(np.repeat(inv_std, C // G, axis=1), layout)
+
+    out = np.multiply(x_hat, gamma)
+    out += beta
+    cache = (x_hat, inv_std, gamma, G, layout)
+    return out, cache
+
+
+def spatial_groupnorm_backward_fused(dout, cache):
+    """
+    Fused backward pass for spatial group normalization, using the closed form
+
+    dx = inv_std * (dy - mean_g(dy) - x_hat * mean_g(dy * x_hat))
+
+    with dy = gamma * dout and mean_g the mean over a group. Only two passes
+    over dout are needed to reduce it: the per-channel sums of dout and of
+    dout * x_hat give dbeta and dgamma when summed over N, and the two group
+    means when weighted by gamma and summed over the channels of each group.
+    dx is then built from per-(n, c) coefficients with a single temporary.
+
+    Inputs:
+    - dout: Upstream derivatives, in the layout of the forward pass
+    - cache: Values from spatial_groupnorm_forward_fused
+
+    Returns a tuple of:
+    - dx: Gradient with respect to inputs, of the same shape as dout
+    - dgamma: Gradient with respect to scale parameter, of the shape of gamma
+    - dbeta: Gradient with respect to shift parameter, of the shape of gamma
+    """
+    x_hat, inv_std, gamma, G, layout = cache
+    N = dout.shape[0]
+    group_size = dout.size // (N * G)
+
+    sum_dout = _channel_sums(dout, None, layout)
+    sum_dout_x_hat = _channel_sums(dout, x_hat, layout)
+    dbeta = sum_dout.sum(axis=0).reshape(gamma.shape)
+    dgamma = sum_dout_x_hat.sum(axis=0).reshape(gamma.shape)
+
+    gamma_c = gamma.reshape(1, -1)
+    C = gamma_c.shape[1]
+    mean_dy = (sum_dout * gamma_c).reshape(N, G, -1).sum(axis=2) / group_size
+    mean_dy_x_hat = (sum_dout_x_hat * gamma_c).reshape(N, G, -1).sum(axis=2) / group_size
+    inv_std_c = np.repeat(inv_std, C // G, axis=1)
+
+    dx = np.multiply(dout, _per_channel(inv_std_c * gamma_c, layout))
+    dx -= x_hat * _per_channel(np.repeat(inv_std * mean_dy_x_hat, C // G, axis=1), layout)
+    dx -= _per_channel(np.repeat(inv_std * mean_dy, C // G, axis=1), layout)
+    return dx, dgamma, dbeta
+
+
 def svm_loss(x, y):
     """
     Computes the loss and gradient using for multiclass SVM classification.
@@ -994,3 +1278,406 @@ def softmax_loss(x, y):
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return loss, dx
+
+
+def _sample_classes(num_classes, num_sampled, sampler, rng):
+    """
+    Draw num_sampled class indices with replacement from the proposal
+    distribution, and return them with their proposal probabilities q.
+    The log-uniform (Zipfian) distribution assigns class c the probability
+    log((c + 2) / (c + 1)) / log(C + 1), which suits labels sorted by
+    decreasing frequency; it is sampled by inverting its CDF.
+    """
+    u = rng.random(num_sampled)
+    if sampler == "uniform":
+        sampled = np.minimum((u * num_classes).astype(np.int64), num_classes - 1)
+        return sampled, np.full(num_sampled, 1.0 / num_classes)
+    if sampler != "log_uniform":
+        raise ValueError('Unknown sampler "%s"' % sampler)
+    sampled = np.exp(u * np.log(num_classes + 1)).astype(np.int64) - 1
+    sampled = np.clip(sampled, 0, num_classes - 1)
+    return sampled, log_uniform_probs(sampled, num_classes)
+
+
+def log_uniform_probs(classes, num_classes):
+    """Probabilities of the given classes under the log-uniform proposal."""
+    classes = np.asarray(classes, dtype=np.float64)
+    return np.log((classes + 2.0) / (classes + 1.0)) / np.log(num_classes + 1.0)
+
+
+def sampled_softmax_loss(x, w, b, y, sample_param):
+    """
+    Computes the sampled softmax loss of the affine output layer
+    scores = x.dot(w) + b, and its gradients, without computing the scores of
+    every class.
+
+    The loss is the softmax loss over the true class of each example and
+    num_sampled classes drawn from a proposal distribution Q, shared by the
+    whole minibatch. Each logit s_c is corrected to s_c - log(S * Q(c)),
+    where S * Q(c) is the expected number of times class c is drawn; with
+    this correction the gradient is a consistent estimate of the full softmax
+    gradient. A sampled class that equals the true class of an example is
+    removed from that example's softmax. The cost per example is O(D * S)
+    instead of O(D * C); only the dense gradient arrays dw and db are of
+    size O(D * C), and they are zero outside the touched columns.
+
+    The model is trained for the full softmax, so at test time the scores
+    are x.dot(w) + b as usual.
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - w: Weights of the output layer, of shape (D, C)
+    - b: Biases of the output layer, of shape (C,)
+    - y: Vector of labels, of shape (N,)
+    - sample_param: A dictionary with the following keys:
+      - num_sampled: Number S of classes to sample per minibatch
+      - sampler: 'log_uniform' (the default) or 'uniform'
+      - seed / rng: As for dropout_forward
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient with respect to x, of shape (N, D)
+    - dw: Gradient with respect to w, of shape (D, C)
+    - db: Gradient with respect to b, of shape (C,)
+    """
+    if "seed" in sample_param:
+        rng = np.random.default_rng(sample_param["seed"])
+    else:
+        rng = sample_param.get("rng", np.random)
+    N = x.shape[0]
+    C = w.shape[1]
+    sampler = sample_param.get("sampler", "log_uniform")
+    num_sampled = sample_param["num_sampled"]
+    sampled, q_sampled = _sample_classes(C, num_sampled, sampler, rng)
+    if sampler == "uniform":
+        q_true = np.full(N, 1.0 / C)
+    else:
+        q_true = log_uniform_probs(y, C)
+
+    # Column 0 holds the true class of each example, columns 1..S the
+    # sampled classes.
+    w_true = w[:, y]
+    w_sampled = w[:, sampled]
+    logits = np.empty((N, num_sampled + 1), dtype=np.result_type(x, w))
+    logits[:, 0] = np.einsum("ij,ji->i", x, w_true) + b[y] - np.log(num_sampled * q_true)
+    logits[:, 1:] = x.dot(w_sampled) + (b[sampled] - np.log(num_sampled * q_sampled))
+    logits[:, 1:][sampled[None, :] == y[:, None]] = -np.inf
+
+    logits -= logits.max(axis=1, keepdims=True)
+    exp_logits = np.exp(logits)
+    sum_exp = exp_logits.sum(axis=1, keepdims=True)
+    loss = np.sum(np.log(sum_exp[:, 0]) - logits[:, 0]) / N
+    dlogits = exp_logits / sum_exp
+    dlogits[:, 0] -= 1
+    dlogits /= N
+
+    dx = dlogits[:, :1] * w_true.T + dlogits[:, 1:].dot(w_sampled.T)
+
+    # Classes can occur several times among y and the samples. The gradient
+    # of the scores is therefore first gathered into one column per distinct
+    # candidate class, merging the duplicates of the samples with a one-hot
+    # matrix product, so that dw is a single (D, N) by (N, U) product.
+    classes, inverse = np.unique(np.concatenate([y, sampled]), return_inverse=True)
+    one_hot = (inverse[N:, None] == np.arange(len(classes))).astype(dlogits.dtype)
+    dclasses = dlogits[:, 1:].dot(one_hot)
+    dclasses[np.arange(N), inverse[:N]] += dlogits[:, 0]
+    dw = np.zeros_like(w)
+    db = np.zeros_like(b)
+    dw[:, classes] = x.T.dot(dclasses)
+    db[classes] = dclasses.sum(axis=0)
+    return loss, dx, dw, db
+
+
+def _cluster_slices(num_classes, cluster_size):
+    return [
+        slice(start, min(start + cluster_size, num_classes))
+        for start in range(0, num_classes, cluster_size)
+    ]
+
+
+def hierarchical_softmax_loss(x, w, b, w_cluster, b_cluster, y, cluster_size):
+    """
+    Computes the loss and gradients of a two-level hierarchical softmax.
+
+    The classes are split into contiguous clusters of cluster_size classes,
+    class c belonging to cluster c // cluster_size, and the probability of a
+    class factorizes as p(c | x) = p(cluster | x) * p(c | cluster, x). The
+    first factor is a softmax over the K clusters with scores
+    x.dot(w_cluster) + b_cluster, the second a softmax over the classes of the
+    cluster with the scores x.dot(w) + b restricted to them. With
+    cluster_size close to sqrt(C) the cost per example is O(D * sqrt(C))
+    instead of O(D * C). Classes that are often confused should share a
+    cluster, so it helps to number the classes accordingly.
+
+    Inputs:
+    - x: Input data, of shape (N, D)
+    - w: Class weights, of shape (D, C)
+    - b: Class biases, of shape (C,)
+    - w_cluster: Cluster weights, of shape (D, K) with K = ceil(C / cluster_size)
+    - b_cluster: Cluster biases, of shape (K,)
+    - y: Vector of labels, of shape (N,)
+    - cluster_size: Number of classes per cluster
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient with respect to x, of shape (N, D)
+    - dw, db, dw_cluster, db_cluster: Gradients with respect to the weights
+      and biases, of the same shapes as these
+    """
+    N = x.shape[0]
+    clusters = y // cluster_size
+    loss, dscores = softmax_loss(x.dot(w_cluster) + b_cluster, clusters)
+    loss *= N
+    dscores *= N
+    dx = dscores.dot(w_cluster.T)
+    dw_cluster = x.T.dot(dscores)
+    db_cluster = dscores.sum(axis=0)
+
+    # The second level runs one small softmax per cluster present in the
+    # minibatch, over the examples of that cluster.
+    dw = np.zeros_like(w)
+    db = np.zeros_like(b)
+    slices = _cluster_slices(w.shape[1], cluster_size)
+    for k in np.unique(clusters):
+        rows = np.flatnonzero(clusters == k)
+        cols = slices[k]
+        x_k = x[rows]
+        inner_loss, dinner = softmax_loss(x_k.dot(w[:, cols]) + b[cols], y[rows] - cols.start)
+        loss += inner_loss * len(rows)
+        dinner *= len(rows)
+        dx[rows] += dinner.dot(w[:, cols].T)
+        dw[:, cols] = x_k.T.dot(dinner)
+        db[cols] = dinner.sum(axis=0)
+
+    loss /= N
+    for grad in (dx, dw, db, dw_cluster, db_cluster):
+        grad /= N
+    return loss, dx, dw, db, dw_cluster, db_cluster
+
+
+def hierarchical_softmax_scores(x, w, b, w_cluster, b_cluster, cluster_size):
+    """
+    Computes the log-probabilities log p(c | x) of all classes under a
+    two-level hierarchical softmax, for evaluation. This is the full O(D * C)
+    computation.
+
+    Inputs are as for hierarchical_softmax_loss, without y.
+
+    Returns:
+    - scores: Array of shape (N, C) of log-probabilities
+    """
+    return hierarchical_log_probs(x.dot(w) + b, x.dot(w_cluster) + b_cluster, cluster_size)
+
+
+def hierarchical_log_probs(scores, cluster_scores, cluster_size):
+    """
+    Combine the class and cluster scores of a two-level hierarchical softmax
+    into the log-probabilities log p(c | x) of all classes.
+
+    Inputs:
+    - scores: Array of shape (N, C) of class scores; overwritten
+    - cluster_scores: Array of shape (N, K) of cluster scores
+    - cluster_size: Number of classes per cluster
+
+    Returns:
+    - scores: Array of shape (N, C) of log-probabilities
+    """
+    def log_softmax(s):
+        s = s - s.max(axis=1, keepdims=True)
+        return s - np.log(np.exp(s).sum(axis=1, keepdims=True))
+
+    cluster_scores = log_softmax(cluster_scores)
+    for k, cols in enumerate(_cluster_slices(scores.shape[1], cluster_size)):
+        scores[:, cols] = log_softmax(scores[:, cols]) + cluster_scores[:, k:k + 1]
+    return scores
+
+
+def quantize_int8(x, scale):
+    """
+    Symmetric linear quantization of a floating point array to int8.
+
+    Inputs:
+    - x: Array of any shape
+    - scale: Scalar, or array broadcastable against x, giving the real value
+      represented by one integer step.
+
+    Returns:
+    - q: int8 array of the same shape as x with values in [-127, 127], such
+      that q * scale approximates x.
+    """
+    q = np.rint(x / scale)
+    np.clip(q, -127, 127, out=q)
+    return q.astype(np.int8)
+
+
+# Number of int8 products whose sum float32 always holds exactly:
+# D * 127 * 127 < 2 ** 24.
+_EXACT_FLOAT32_ROWS = (2 ** 24 - 1) // (127 * 127)
+
+
+def widen_int8_weights(w_q):
+    """
+    Convert int8 weights once to the float32 that quantized_affine_forward
+    multiplies them in, so that forward passes do not have to convert them
+    again. The result takes 4 bytes per weight instead of 1.
+    """
+    return w_q.astype(np.float32)
+
+
+def quantized_affine_forward(x, w_q, w_scale, b, x_scale, block_rows=256):
+    """
+    Test-time forward pass for an affine layer with int8 weights.
+
+    The input is quantized to int8 with a single per-tensor scale, multiplied
+    by the int8 weights with exact integer accumulation and then rescaled back
+    to floating point before the bias is added.
+
+    numpy has no int8 GEMM, so the integer operands are multiplied as float32,
+    which holds the sum of up to 1040 int8 products exactly. Longer dot
+    products are split into blocks of at most that many rows of the weights,
+    whose float32 products are summed in float64. The result is therefore
+    identical to int32 accumulation.
+
+    The weights can be given either as int8, or already converted to float32
+    by widen_int8_weights. Int8 weights are converted block_rows rows at a
+    time, so only a small block is ever held as floats, but the conversion is
+    paid again on every call; pre-widened weights skip the conversion, at the
+    cost of keeping the float32 copy in memory.
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - w_q: int8 weights, or weights returned by widen_int8_weights, of shape
+      (D, M)
+    - w_scale: Per-output scale of the weights, of shape (M,)
+    - b: Floating point biases, of shape (M,)
+    - x_scale: Scalar scale used to quantize the input
+    - block_rows: Number of rows of int8 weights converted at a time
+
+    Returns:
+    - out: output, of shape (N, M)
+    """
+    x_q = quantize_int8(x.reshape(x.shape[0], -1), x_scale).astype(np.float32)
+    D, M = w_q.shape
+    widened = w_q.dtype == np.float32
+    if widened and D <= _EXACT_FLOAT32_ROWS:
+        acc = x_q.dot(w_q)
+    else:
+        rows = _EXACT_FLOAT32_ROWS if widened else min(block_rows, _EXACT_FLOAT32_ROWS)
+        acc_dtype = np.float32 if D <= _EXACT_FLOAT32_ROWS else np.float64
+        acc = np.zeros((x_q.shape[0], M), dtype=acc_dtype)
+        for start in range(0, D, rows):
+            w_block = w_q[start:start + rows]
+            if not widened:
+                w_block = w_block.astype(np.float32)
+            acc += x_q[:, start:start + rows].dot(w_block)
+    out = acc * (x_scale * w_scale) + b
+    return out.astype(b.dtype, copy=False)
+
+
+def lowrank_affine_forward(x, u, v, b):
+    """
+    Computes the forward pass for a rank-r factorized affine layer, whose weight
+    matrix w of shape (D, M) is represented as the product u.dot(v). This costs
+    O(N * r * (D + M)) instead of O(N * D * M).
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - u: First factor of the weights, of shape (D, r)
+    - v: Second factor of the weights, of shape (r, M)
+    - b: A numpy array of biases, of shape (M,)
+
+    Returns a tuple of:
+    - out: output, of shape (N, M)
+    - cache: (x, u, v, xu)
+    """
+    xu = x.reshape(x.shape[0], -1).dot(u)
+    out = xu.dot(v) + b
+    cache = (x, u, v, xu)
+    return out, cache
+
+
+def lowrank_affine_backward(dout, cache, needs_input_grad=True):
+    """
+    Computes the backward pass for a rank-r factorized affine layer.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: Tuple of (x, u, v, xu) as returned by lowrank_affine_forward
+    - needs_input_grad: If False, dx is not computed and None is returned.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k), or None
+    - du: Gradient with respect to u, of shape (D, r)
+    - dv: Gradient with respect to v, of shape (r, M)
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x, u, v, xu = cache
+    db = np.sum(dout, axis=0)
+    dv = xu.T.dot(dout)
+    dxu = dout.dot(v.T)
+    du = x.reshape(x.shape[0], -1).T.dot(dxu)
+    dx = None
+    if needs_input_grad:
+        dx = dxu.dot(u.T).reshape(x.shape)
+    return dx, du, dv, db
+
+
+def sparse_affine_forward(x, w, b):
+    """
+    Computes the forward pass for an affine layer whose weights are stored as a
+    sparse matrix, so that the cost is O(N * nnz) instead of O(N * D * M).
+
+    Inputs:
+    - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
+    - w: A scipy.sparse.csr_matrix of weights, of shape (D, M)
+    - b: A numpy array of biases, of shape (M,)
+
+    Returns a tuple of:
+    - out: output, of shape (N, M)
+    - cache: (x, w)
+    """
+    x_reshaped = x.reshape(x.shape[0], -1)
+    out = np.asarray(w.T.dot(x_reshaped.T)).T + b
+    cache = (x, w)
+    return out, cache
+
+
+def sparse_affine_backward(dout, cache, needs_input_grad=True, chunk_size=2 ** 20):
+    """
+    Computes the backward pass for a sparse affine layer. The gradient with
+    respect to the weights is only computed at the non-zero positions of w, so
+    the sparsity pattern of w never changes during training.
+
+    Inputs:
+    - dout: Upstream derivative, of shape (N, M)
+    - cache: Tuple of (x, w) as returned by sparse_affine_forward
+    - needs_input_grad: If False, dx is not computed and None is returned.
+    - chunk_size: Upper bound on N * (number of weights handled at once), which
+      bounds the temporary memory used for the weight gradient.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k), or None
+    - dw: Gradient with respect to the non-zero entries of w, of shape (nnz,),
+      in the same order as w.data
+    - db: Gradient with respect to b, of shape (M,)
+    """
+    x, w = cache
+    N = x.shape[0]
+    x_reshaped = x.reshape(N, -1)
+    db = np.sum(dout, axis=0)
+
+    # dw[k] = sum_n x[n, rows[k]] * dout[n, cols[k]] for every stored entry k.
+    rows = np.repeat(np.arange(w.shape[0]), np.diff(w.indptr))
+    cols = w.indices
+    dw = np.empty(w.nnz, dtype=np.result_type(x, dout))
+    step = max(1, chunk_size // max(N, 1))
+    for start in range(0, w.nnz, step):
+        end = start + step
+        dw[start:end] = np.einsum(
+            "ij,ij->j", x_reshaped[:, rows[start:end]], dout[:, cols[start:end]]
+        )
+
+    dx = None
+    if needs_input_grad:
+        dx = np.asarray(w.dot(dout.T)).T.reshape(x.shape)
+    return dx, dw, db
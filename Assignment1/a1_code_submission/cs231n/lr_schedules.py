@@ -0,0 +1,151 @@
+from __future__ import division
+from builtins import object
+import math
+
+"""
+Per-iteration learning rate schedules for the Solver.
+
+A schedule gives a multiplier of the base learning rate, the 'learning_rate'
+in the Solver's optim_config, for every iteration. The Solver calls begin()
+once before training, then sets the learning rate of every parameter to
+base_lr * schedule(t) before iteration t, and passes each validation accuracy
+it measures to observe(). Every schedule supports a linear warmup over the
+first warmup_iters iterations, which ramps the multiplier up from
+1 / warmup_iters.
+
+Schedules can be passed to the Solver either as instances or by name, e.g.
+
+solver = Solver(model, data,
+                optim_config={'learning_rate': 1e-3},
+                lr_schedule='cosine',
+                lr_schedule_config={'warmup_iters': 200})
+"""
+
+
+class LRSchedule(object):
+    """A constant learning rate, optionally with a linear warmup."""
+
+    def __init__(self, warmup_iters=0):
+        """
+        Inputs:
+        - warmup_iters: Number of iterations over which the learning rate is
+          ramped up linearly to its scheduled value
+        """
+        self.warmup_iters = warmup_iters
+        self.num_iterations = None
+        self.iterations_per_epoch = None
+
+    def begin(self, num_iterations, iterations_per_epoch):
+        """Called by the Solver before the first iteration."""
+        self.num_iterations = num_iterations
+        self.iterations_per_epoch = iterations_per_epoch
+
+    def factor(self, t):
+        """Multiplier of the base learning rate at iteration t, before warmup."""
+        return 1.0
+
+    def observe(self, val_acc):
+        """Called by the Solver with every validation accuracy it measures."""
+        pass
+
+    def __call__(self, t):
+        factor = self.factor(t)
+        if t < self.warmup_iters:
+            factor *= (t + 1) / self.warmup_iters
+        return factor
+
+
+class CosineSchedule(LRSchedule):
+    """
+    Cosine annealing from the base learning rate down to min_factor times it
+    at the last iteration. The warmup iterations are not part of the cosine.
+    """
+
+    def __init__(self, min_factor=0.0, warmup_iters=0):
+        super(CosineSchedule, self).__init__(warmup_iters)
+        self.min_factor = min_factor
+
+    def factor(self, t):
+        span = max(self.num_iterations - self.warmup_iters - 1, 1)
+        progress = min(max(t - self.warmup_iters, 0) / span, 1.0)
+        cosine = 0.5 * (1 + math.cos(math.pi * progress))
+        return self.min_factor + (1 - self.min_factor) * cosine
+
+
+class StepSchedule(LRSchedule):
+    """Multiplies the learning rate by gamma every step_epochs epochs."""
+
+    def __init__(self, step_epochs=1, gamma=0.1, warmup_iters=0):
+        super(StepSchedule, self).__init__(warmup_iters)
+        self.step_epochs = step_epochs
+        self.gamma = gamma
+
+    def factor(self, t):
+        epoch = t // self.iterations_per_epoch
+        return self.gamma ** (epoch // self.step_epochs)
+
+
+class OneCycleSchedule(LRSchedule):
+    """
+    The one-cycle policy: the learning rate rises from base_lr / div_factor
+    to base_lr over the first pct_start of the iterations, then anneals with
+    a cosine down to base_lr / final_div_factor. The base learning rate is
+    therefore the peak, which can be several times higher than a constant
+    learning rate that trains stably. Since the rise is a warmup by itself,
+    warmup_iters is usually left at 0.
+    """
+
+    def __init__(self, pct_start=0.3, div_factor=25.0, final_div_factor=1e4, warmup_iters=0):
+        super(OneCycleSchedule, self).__init__(warmup_iters)
+        self.pct_start = pct_start
+        self.div_factor = div_factor
+        self.final_div_factor = final_div_factor
+
+    def factor(self, t):
+        peak = max(int(self.pct_start * self.num_iterations), 1)
+        start, end = 1.0 / self.div_factor, 1.0 / self.final_div_factor
+        if t < peak:
+            return start + (1 - start) * t / peak
+        progress = min((t - peak) / max(self.num_iterations - peak - 1, 1), 1.0)
+        return end + (1 - end) * 0.5 * (1 + math.cos(math.pi * progress))
+
+
+class PlateauSchedule(LRSchedule):
+    """
+    Multiplies the learning rate by decay whenever the validation accuracy
+    has not improved by more than threshold for more than patience
+    consecutive checks (the Solver checks once per epoch), down to
+    min_factor times the base learning rate.
+    """
+
+    def __init__(self, decay=0.1, patience=1, threshold=1e-3, min_factor=1e-3, warmup_iters=0):
+        super(PlateauSchedule, self).__init__(warmup_iters)
+        self.decay = decay
+        self.patience = patience
+        self.threshold = threshold
+        self.min_factor = min_factor
+        self.current = 1.0
+        self.best_val_acc = -1.0
+        self.num_bad_checks = 0
+
+    def factor(self, t):
+        return self.current
+
+    def observe(self, val_acc):
+        if val_acc > self.best_val_acc + self.threshold:
+            self.best_val_acc = val_acc
+            self.num_bad_checks = 0
+            return
+        self.num_bad_checks += 1
+        if self.num_bad_checks > self.patience:
+            self.current = max(self.current * self.decay, self.min_factor)
+            self.num_bad_checks = 0
+
+
+SCHEDULES = {
+    "constant": LRSchedule,
+    "cosine": CosineSchedule,
+    "step": StepSchedule,
+    "one_cycle": OneCycleSchedule,
+    "plateau": PlateauSchedule,
+}
@@ -0,0 +1,144 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+"""
+A versioned, pickle-free file format for named numpy arrays, used to save and
+load model parameters. A file consists of:
+
+- the 8 magic bytes b"CS231NMF"
+- the format version and the length of the header, as two little-endian uint32
+- a UTF-8 JSON header {"metadata": {...}, "arrays": [{"name", "dtype",
+  "shape", "offset"}, ...]}
+- the raw array data, each array starting at a multiple of ALIGNMENT bytes
+  from the first one, which itself starts at a multiple of ALIGNMENT bytes.
+
+Since the arrays are stored raw and aligned, load_arrays can memory-map them
+instead of reading them: loading costs O(1) regardless of the model size, and
+several processes that load the same file share a single page-cache copy.
+"""
+
+MAGIC = b"CS231NMF"
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_arrays(fpath, arrays, metadata=None):
+    """
+    Write named arrays and JSON-serializable metadata to fpath.
+
+    Inputs:
+    - fpath: Path of the file to write
+    - arrays: Dictionary mapping names to numpy arrays of non-object dtype
+    - metadata: Optional JSON-serializable dictionary stored in the header
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    entries = []
+    offset = 0
+    for name, arr in arrays.items():
+        if arr.dtype.hasobject:
+            raise ValueError('Array "%s" has object dtype and cannot be saved' % name)
+        offset = _align(offset)
+        entries.append(
+            {"name": name, "dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        )
+        offset += arr.nbytes
+    header = json.dumps({"metadata": metadata or {}, "arrays": entries}).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(fpath, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", VERSION, len(header)))
+        f.write(header)
+        for entry in entries:
+            f.seek(data_start + entry["offset"])
+            arrays[entry["name"]].tofile(f)
+
+
+def is_model_file(fpath):
+    """Return True if fpath starts with the magic bytes of this format."""
+    with open(fpath, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_arrays(fpath, mmap_mode="r"):
+    """
+    Read a file written by save_arrays.
+
+    Inputs:
+    - fpath: Path of the file to read
+    - mmap_mode: How the arrays are mapped into memory: 'r' for read-only
+      views, 'c' for copy-on-write views that can be modified in place without
+      changing the file, or None to read the arrays into memory.
+
+    Returns a tuple of:
+    - arrays: Dictionary mapping names to arrays
+    - metadata: The metadata dictionary given to save_arrays
+    """
+    with open(fpath, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('"%s" is not a cs231n model file' % fpath)
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version > VERSION:
+            raise ValueError('"%s" has unsupported format version %d' % (fpath, version))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _align(len(MAGIC) + 8 + header_len)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        count = int(np.prod(shape))
+        offset = data_start + entry["offset"]
+        if count == 0:
+            arr = np.zeros(shape, dtype=dtype)
+        elif mmap_mode is None:
+            arr = np.fromfile(fpath, dtype=dtype, count=count, offset=offset).reshape(shape)
+        else:
+            arr = np.memmap(fpath, dtype=dtype, mode=mmap_mode, offset=offset, shape=(count,))
+            arr = arr.reshape(shape)
+        arrays[entry["name"]] = arr
+    return arrays, header["metadata"]
+
+
+def load_model(fpath, mmap_mode="c"):
+    """
+    Construct a model from a file written by its save() method, using the
+    architecture config stored in the file.
+
+    Inputs:
+    - fpath: Path of the model file
+    - mmap_mode: Passed to load_arrays
+
+    Returns:
+    - model: A TwoLayerNet, FullyConnectedNet, LinearSVM or Softmax instance
+    """
+    from .classifiers import fc_net, linear_classifier
+
+    arrays, metadata = load_arrays(fpath, mmap_mode)
+    classes = {
+        "TwoLayerNet": fc_net.TwoLayerNet,
+        "FullyConnectedNet": fc_net.FullyConnectedNet,
+        "LinearSVM": linear_classifier.LinearSVM,
+        "Softmax": linear_classifier.Softmax,
+    }
+    if metadata.get("class") not in classes:
+        raise ValueError('Unknown model class "%s"' % metadata.get("class"))
+    config = dict(metadata.get("config", {}))
+    if "dtype" in config:
+        config["dtype"] = np.dtype(config["dtype"]).type
+    cls = classes[metadata["class"]]
+    if cls in (fc_net.TwoLayerNet, fc_net.FullyConnectedNet):
+        # The weights come from the file, so skip their random
+        # initialization, which would cost time and memory proportional to
+        # the model size and advance the global random state.
+        config["_skip_init"] = True
+    model = cls(**config)
+    model.set_state(arrays, metadata)
+    return model
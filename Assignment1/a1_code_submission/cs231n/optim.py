@@ -164,3 +164,266 @@ def adam(w, dw, config=None):
     ###########################################################################
 
     return next_w, config
+
+
+def _trust_ratio(w_norm, update_norm, eta=1.0):
+    # Layers with zero weights (e.g. just initialized to zero) or a zero
+    # update fall back to the global learning rate.
+    if w_norm > 0 and update_norm > 0:
+        return eta * w_norm / update_norm
+    return 1.0
+
+
+def lars(w, dw, config=None):
+    """
+    Uses LARS (layer-wise adaptive rate scaling), SGD with momentum in which
+    the learning rate of every parameter array is multiplied by a trust ratio
+    eta * ||w|| / ||dw + weight_decay * w||. Every layer then moves by about
+    the same fraction of its weights, which keeps training stable with the
+    large learning rates that large batches need.
+
+    Biases and normalization parameters (arrays with fewer than 2 dimensions)
+    are updated with plain SGD with momentum, without weight decay.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - momentum: Scalar between 0 and 1 giving the momentum value.
+    - eta: Trust coefficient.
+    - weight_decay: L2 weight decay, coupled as in the LARS paper: the term
+      weight_decay * w is added to the gradient before the trust ratio and
+      the momentum are applied. It replaces the model's reg, which should be
+      kept at 0 when using it.
+    - velocity: A numpy array of the same shape as w, the momentum buffer.
+    """
+    if config is None:
+        config = {}
+    config.setdefault("learning_rate", 1e-1)
+    config.setdefault("momentum", 0.9)
+    config.setdefault("eta", 1e-3)
+    config.setdefault("weight_decay", 0.0)
+    if "velocity" not in config:
+        config["velocity"] = np.zeros_like(w)
+
+    update = dw
+    trust_ratio = 1.0
+    if w.ndim >= 2:
+        if config["weight_decay"] > 0:
+            update = dw + config["weight_decay"] * w
+        trust_ratio = _trust_ratio(np.linalg.norm(w), np.linalg.norm(update), config["eta"])
+
+    v = config["velocity"]
+    v *= config["momentum"]
+    v -= (config["learning_rate"] * trust_ratio) * update
+    w += v
+    return w, config
+
+
+def lamb(w, dw, config=None):
+    """
+    Uses LAMB (layer-wise adaptive moments), Adam in which the update r of
+    every parameter array is rescaled by the trust ratio ||w|| / ||r||, with
+    r = m_hat / (sqrt(v_hat) + epsilon) + weight_decay * w. As for LARS,
+    arrays with fewer than 2 dimensions get the plain Adam update without
+    weight decay.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - beta1, beta2, epsilon, m, v, t: As for adam.
+    - weight_decay: Decoupled L2 weight decay; keep the model's reg at 0
+      when using it.
+    """
+    if config is None:
+        config = {}
+    config.setdefault("learning_rate", 1e-3)
+    config.setdefault("beta1", 0.9)
+    config.setdefault("beta2", 0.999)
+    config.setdefault("epsilon", 1e-6)
+    config.setdefault("weight_decay", 0.0)
+    if "m" not in config:
+        config["m"] = np.zeros_like(w)
+        config["v"] = np.zeros_like(w)
+        config["t"] = 0
+
+    config["t"] += 1
+    beta1, beta2, t = config["beta1"], config["beta2"], config["t"]
+    m, v = config["m"], config["v"]
+    m *= beta1
+    m += (1 - beta1) * dw
+    v *= beta2
+    v += (1 - beta2) * (dw * dw)
+
+    update = m / (1 - beta1 ** t)
+    update /= np.sqrt(v / (1 - beta2 ** t)) + config["epsilon"]
+    trust_ratio = 1.0
+    if w.ndim >= 2:
+        if config["weight_decay"] > 0:
+            update += config["weight_decay"] * w
+        trust_ratio = _trust_ratio(np.linalg.norm(w), np.linalg.norm(update))
+
+    w -= (config["learning_rate"] * trust_ratio) * update
+    return w, config
+
+
+# In-place, multi-tensor variants of the update rules above. They compute the
+# same updates, but write the new weights into w and update the state buffers
+# in config with out= ufuncs, using one scratch buffer per tensor that is
+# allocated on the first call and reused afterwards, so that a step does not
+# allocate any full-size arrays. They return w itself as next_w.
+#
+# w and dw may also be lists of arrays, such as all parameters of a model; the
+# state in config is then a list of buffers as well, and the scalar work (step
+# counter, bias corrections) is done once per call. Parameters that are views
+# of a single flat buffer (see flatten_arrays) can be updated with one call on
+# the flat buffer and a flat gradient, which makes the number of ufunc calls
+# per step independent of the number of parameters.
+
+
+def _tensors(x):
+    """Return x as a list of arrays, for rules that take an array or a list."""
+    return list(x) if isinstance(x, (list, tuple)) else [x]
+
+
+def _zeros_like(w):
+    if isinstance(w, (list, tuple)):
+        return [np.zeros_like(w_i) for w_i in w]
+    return np.zeros_like(w)
+
+
+def _setdefault_zeros(config, key, w):
+    # Unlike config.setdefault(key, _zeros_like(w)), this does not allocate
+    # new buffers on every call.
+    if key not in config:
+        config[key] = _zeros_like(w)
+
+
+def flatten_arrays(arrays, out=None):
+    """
+    Copy a list of arrays into one contiguous 1-d buffer.
+
+    Inputs:
+    - arrays: List of arrays
+    - out: Optional 1-d buffer of the total size to copy into, e.g. the flat
+      buffer of a previous call, so that per-step gradients can be flattened
+      without allocating.
+
+    Returns a tuple of:
+    - flat: 1-d array holding the elements of all arrays, in order
+    - views: List of views of flat with the shapes of the arrays; writing to
+      them writes to flat and vice versa
+    """
+    if out is None:
+        size = sum(a.size for a in arrays)
+        out = np.empty(size, dtype=np.result_type(*arrays))
+    views = []
+    start = 0
+    for a in arrays:
+        view = out[start:start + a.size].reshape(a.shape)
+        view[...] = a
+        views.append(view)
+        start += a.size
+    return out, views
+
+
+def sgd_momentum_inplace(w, dw, config=None):
+    """
+    In-place version of sgd_momentum; w and dw may be lists of arrays.
+
+    config format: Same as sgd_momentum, plus
+    - scratch: Temporary buffer(s) of the shape of w.
+    """
+    if config is None:
+        config = {}
+    config.setdefault("learning_rate", 1e-2)
+    config.setdefault("momentum", 0.9)
+    _setdefault_zeros(config, "velocity", w)
+    _setdefault_zeros(config, "scratch", w)
+
+    lr, mu = config["learning_rate"], config["momentum"]
+    for w_i, dw_i, v, s in zip(
+        _tensors(w), _tensors(dw), _tensors(config["velocity"]), _tensors(config["scratch"])
+    ):
+        v *= mu
+        np.multiply(dw_i, lr, out=s)
+        v -= s
+        w_i += v
+    return w, config
+
+
+def rmsprop_inplace(w, dw, config=None):
+    """
+    In-place version of rmsprop; w and dw may be lists of arrays.
+
+    config format: Same as rmsprop, plus
+    - scratch: Temporary buffer(s) of the shape of w.
+    """
+    if config is None:
+        config = {}
+    config.setdefault("learning_rate", 1e-2)
+    config.setdefault("decay_rate", 0.99)
+    config.setdefault("epsilon", 1e-8)
+    _setdefault_zeros(config, "cache", w)
+    _setdefault_zeros(config, "scratch", w)
+
+    lr, decay, eps = config["learning_rate"], config["decay_rate"], config["epsilon"]
+    for w_i, dw_i, cache, s in zip(
+        _tensors(w), _tensors(dw), _tensors(config["cache"]), _tensors(config["scratch"])
+    ):
+        cache *= decay
+        np.square(dw_i, out=s)
+        s *= 1 - decay
+        cache += s
+        np.sqrt(cache, out=s)
+        s += eps
+        np.divide(dw_i, s, out=s)
+        s *= lr
+        w_i -= s
+    return w, config
+
+
+def adam_inplace(w, dw, config=None):
+    """
+    In-place version of adam; w and dw may be lists of arrays.
+
+    The bias corrections are folded into the step size and epsilon,
+
+    m_hat / (sqrt(v_hat) + eps) = m * c / (sqrt(v) + eps * sqrt(1 - beta2 ** t))
+
+    with c = sqrt(1 - beta2 ** t) / (1 - beta1 ** t), so m_hat and v_hat are
+    never formed.
+
+    config format: Same as adam, plus
+    - scratch: Temporary buffer(s) of the shape of w.
+    """
+    if config is None:
+        config = {}
+    config.setdefault("learning_rate", 1e-3)
+    config.setdefault("beta1", 0.9)
+    config.setdefault("beta2", 0.999)
+    config.setdefault("epsilon", 1e-8)
+    _setdefault_zeros(config, "m", w)
+    _setdefault_zeros(config, "v", w)
+    config.setdefault("t", 0)
+    _setdefault_zeros(config, "scratch", w)
+
+    config["t"] += 1
+    beta1, beta2, t = config["beta1"], config["beta2"], config["t"]
+    correction2 = np.sqrt(1 - beta2 ** t)
+    step_size = config["learning_rate"] * correction2 / (1 - beta1 ** t)
+    eps = config["epsilon"] * correction2
+    for w_i, dw_i, m, v, s in zip(
+        _tensors(w), _tensors(dw), _tensors(config["m"]), _tensors(config["v"]),
+        _tensors(config["scratch"]),
+    ):
+        m *= beta1
+        np.multiply(dw_i, 1 - beta1, out=s)
+        m += s
+        v *= beta2
+        np.square(dw_i, out=s)
+        s *= 1 - beta2
+        v += s
+        np.sqrt(v, out=s)
+        s += eps
+        np.divide(m, s, out=s)
+        s *= step_size
+        w_i -= s
+    return w, config
@@ -0,0 +1,231 @@
+from builtins import range
+from builtins import object
+import time
+
+import numpy as np
+import scipy.sparse
+
+from .layers import *
+
+"""
+Post-training int8 quantization for the fully-connected models in
+classifiers/fc_net.py (TwoLayerNet and FullyConnectedNet).
+
+Typical usage:
+
+qmodel = QuantizedNet(model, data['X_val'][:1000])
+report = quantization_report(model, qmodel, data['X_val'], data['y_val'])
+
+Weights are stored as int8 with one scale per output unit; the input of every
+affine layer is quantized with a per-tensor scale that is calibrated once on a
+sample of data. Batch normalization is folded into the preceding affine layer
+using its running statistics, while layer normalization is applied in floating
+point after the quantized affine layer. Dropout is a no-op at test time.
+With a hierarchical softmax output, the cluster scores come from a second
+quantized affine layer on the same input as the output layer, and the scores
+are the same log-probabilities as those of the float model.
+
+numpy has no int8 matrix multiply, so the int8 weights have to be converted
+to float32 to be multiplied. By default QuantizedNet keeps only the int8
+weights and converts them in small blocks on every forward pass, so that the
+model takes about a quarter of the memory of the float model. With
+widen_weights=True it converts them once when it is built and keeps the
+float32 copies, which saves the conversions but takes more memory than the
+float model; nbytes() and quantization_report count those copies.
+"""
+
+
+def _float_layers(model):
+    """
+    Yield (W, b, ln) for every affine layer of a trained model, with batch
+    normalization folded into W and b. ln is None, or a tuple (gamma, beta,
+    ln_param) when the layer is followed by layer normalization.
+    """
+    num_layers = getattr(model, "num_layers", 2)
+    normalization = getattr(model, "normalization", None)
+    for i in range(1, num_layers + 1):
+        if "U%d" % i in model.params:
+            W = model.params["U%d" % i].dot(model.params["V%d" % i])
+        elif i in getattr(model, "sparse_layers", {}):
+            indices, indptr, shape = model.sparse_layers[i]
+            W = scipy.sparse.csr_matrix(
+                (model.params["W%d" % i], indices, indptr), shape=shape
+            ).toarray()
+        else:
+            W = model.params["W%d" % i]
+        b = model.params["b%d" % i]
+        ln = None
+        if normalization == "batchnorm" and i < num_layers:
+            bn_param = model.bn_params[i - 1]
+            if "running_mean" not in bn_param:
+                raise ValueError("batchnorm layer %d has no running statistics" % i)
+            gamma, beta = model.params["gamma%d" % i], model.params["beta%d" % i]
+            eps = bn_param.get("eps", 1e-5)
+            s = gamma / np.sqrt(bn_param["running_var"] + eps)
+            W = W * s
+            b = (b - bn_param["running_mean"]) * s + beta
+        elif normalization == "layernorm" and i < num_layers:
+            gamma, beta = model.params["gamma%d" % i], model.params["beta%d" % i]
+            ln = (gamma, beta, model.bn_params[i - 1])
+        yield W, b, ln
+
+
+def _quantize_affine(W, b, widen_weights):
+    """Quantize the weights of an affine layer to int8 with per-output scales."""
+    w_scale = np.abs(W).max(axis=0) / 127.0
+    w_scale[w_scale == 0] = 1.0
+    w_q = quantize_int8(W, w_scale)
+    return {"w_q": w_q, "w_scale": w_scale.astype(np.float32), "b": b.astype(np.float32),
+            "w_acc": widen_int8_weights(w_q) if widen_weights else None}
+
+
+def _quantized_forward(x, layer, x_scale):
+    w = layer["w_q"] if layer["w_acc"] is None else layer["w_acc"]
+    return quantized_affine_forward(x, w, layer["w_scale"], layer["b"], x_scale)
+
+
+class QuantizedNet(object):
+    """
+    Int8 inference copy of a trained TwoLayerNet or FullyConnectedNet.
+
+    A QuantizedNet exposes the test-time half of the model API, so it can be
+    passed anywhere a model is used for prediction, e.g. Solver.check_accuracy.
+    """
+
+    def __init__(self, model, X_calib, batch_size=100, widen_weights=False):
+        """
+        Quantize a trained model.
+
+        Inputs:
+        - model: A trained TwoLayerNet or FullyConnectedNet
+        - X_calib: Array of shape (N, d_1, ..., d_k) of representative inputs,
+          e.g. a sample of X_val, used to calibrate the activation scales.
+        - batch_size: Number of calibration examples to run at once.
+        - widen_weights: If True, keep a copy of the int8 weights converted to
+          float32 for the matrix multiplies, trading memory for speed.
+        """
+        float_layers = list(_float_layers(model))
+        self.layers = []
+        for W, b, ln in float_layers:
+            layer = _quantize_affine(W, b, widen_weights)
+            layer.update(ln=ln, x_absmax=0.0)
+            self.layers.append(layer)
+
+        # The cluster layer of a hierarchical softmax shares the input, and
+        # therefore the input scale, of the output layer.
+        self.cluster_layer = None
+        self.cluster_size = None
+        if getattr(model, "output_loss", "softmax") == "hierarchical_softmax":
+            self.cluster_layer = _quantize_affine(
+                model.params["W_cluster"], model.params["b_cluster"], widen_weights
+            )
+            self.cluster_size = model.output_loss_param["cluster_size"]
+
+        # Calibrate the per-tensor input scale of every affine layer by running
+        # the floating point model on the calibration data.
+        for start in range(0, X_calib.shape[0], batch_size):
+            h = X_calib[start:start + batch_size]
+            h = h.reshape(h.shape[0], -1)
+            for layer, (W, b, ln) in zip(self.layers, float_layers):
+                layer["x_absmax"] = max(layer["x_absmax"], float(np.abs(h).max()))
+                h, _ = affine_forward(h, W, b)
+                if ln is not None:
+                    h, _ = layernorm_forward(h, ln[0], ln[1], ln[2])
+                h = np.maximum(h, 0)
+        for layer in self.layers:
+            layer["x_scale"] = max(layer.pop("x_absmax"), 1e-8) / 127.0
+
+    def loss(self, X, y=None):
+        """
+        Compute classification scores for a minibatch of data.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+        - y: Must be None; a quantized model cannot be trained.
+
+        Returns:
+        - scores: Array of shape (N, C) giving classification scores.
+        """
+        if y is not None:
+            raise ValueError("QuantizedNet only supports test-time forward passes")
+        h = X
+        for i, layer in enumerate(self.layers):
+            x = h
+            h = _quantized_forward(x, layer, layer["x_scale"])
+            if i == len(self.layers) - 1:
+                break
+            if layer["ln"] is not None:
+                gamma, beta, ln_param = layer["ln"]
+                h, _ = layernorm_forward(h, gamma, beta, ln_param)
+            h = np.maximum(h, 0)
+        if self.cluster_layer is not None:
+            cluster_scores = _quantized_forward(x, self.cluster_layer, layer["x_scale"])
+            h = hierarchical_log_probs(h, cluster_scores, self.cluster_size)
+        return h
+
+    def nbytes(self):
+        """
+        Return the number of bytes taken by the quantized parameters,
+        including the float32 copies kept with widen_weights.
+        """
+        total = 0
+        for layer in self.layers + [self.cluster_layer]:
+            if layer is None:
+                continue
+            total += layer["w_q"].nbytes + layer["w_scale"].nbytes + layer["b"].nbytes
+            if layer["w_acc"] is not None:
+                total += layer["w_acc"].nbytes
+            if layer.get("ln") is not None:
+                total += layer["ln"][0].nbytes + layer["ln"][1].nbytes
+        return total
+
+
+def accuracy_and_time(model, X, y, batch_size=100):
+    """
+    Return the accuracy of model on (X, y) and the seconds taken to predict X
+    in batches of batch_size.
+    """
+    y_pred = []
+    tic = time.perf_counter()
+    for start in range(0, X.shape[0], batch_size):
+        scores = model.loss(X[start:start + batch_size])
+        y_pred.append(np.argmax(scores, axis=1))
+    elapsed = time.perf_counter() - tic
+    return np.mean(np.hstack(y_pred) == y), elapsed
+
+
+def quantization_report(model, qmodel, X, y, batch_size=100, num_repeats=3):
+    """
+    Compare a floating point model against its quantized copy.
+
+    Inputs:
+    - model: The original TwoLayerNet or FullyConnectedNet
+    - qmodel: A QuantizedNet built from model
+    - X, y: Evaluation data and labels, e.g. X_val and y_val
+    - batch_size: Batch size used for inference
+    - num_repeats: Latencies are the best of this many passes over X
+
+    Returns a dictionary with keys:
+    - float_acc, int8_acc, acc_drop: Accuracies of both models and their difference
+    - float_bytes, int8_bytes, size_ratio: Parameter sizes and their ratio
+    - float_time, int8_time, speedup: Seconds for one pass over X and their ratio
+    """
+    float_times, int8_times = [], []
+    for _ in range(num_repeats):
+        float_acc, t = accuracy_and_time(model, X, y, batch_size)
+        float_times.append(t)
+        int8_acc, t = accuracy_and_time(qmodel, X, y, batch_size)
+        int8_times.append(t)
+    float_bytes = sum(v.nbytes for v in model.params.values())
+    int8_bytes = qmodel.nbytes()
+    return {
+        "float_acc": float_acc,
+        "int8_acc": int8_acc,
+        "acc_drop": float_acc - int8_acc,
+        "float_bytes": float_bytes,
+        "int8_bytes": int8_bytes,
+        "size_ratio": float_bytes / int8_bytes,
+        "float_time": min(float_times),
+        "int8_time": min(int8_times),
+        "speedup": min(float_times) / min(int8_times),
+    }
@@ -4,12 +4,96 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import range
 from builtins import object
+import glob
 import os
-import pickle as pickle
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 
 from cs231n import optim
+from cs231n import lr_schedules
+from cs231n.data_loader import PrefetchLoader
+from cs231n.model_io import save_arrays, load_arrays
+
+
+def _accuracy(model, X, y, batch_size=100):
+    """Fraction of the examples of X that model classifies as y."""
+    N = X.shape[0]
+    num_batches = N // batch_size
+    if N % batch_size != 0:
+        num_batches += 1
+    y_pred = []
+    for i in range(num_batches):
+        start = i * batch_size
+        end = (i + 1) * batch_size
+        scores = model.loss(X[start:end])
+        y_pred.append(np.argmax(scores, axis=1))
+    y_pred = np.hstack(y_pred)
+    return np.mean(y_pred == y)
+
+
+# State of an asynchronous evaluation worker process: a copy of the model and
+# the training and validation data, sent once when the worker starts.
+_eval_model = None
+_eval_data = None
+
+
+def _init_eval_worker(model, data):
+    global _eval_model, _eval_data
+    _eval_model = model
+    _eval_data = data
+
+
+def _evaluate(params, bn_params, train_mask, val_mask):
+    """
+    Compute the train and val accuracy of a snapshot of the model parameters
+    in an evaluation worker. The masks select the examples to use, or are
+    None to use all of them.
+    """
+    _eval_model.params = params
+    if bn_params is not None:
+        _eval_model.bn_params = bn_params
+    accs = []
+    for split, mask in (("train", train_mask), ("val", val_mask)):
+        X, y = _eval_data["X_" + split], _eval_data["y_" + split]
+        if mask is not None:
+            X, y = X[mask], y[mask]
+        accs.append(_accuracy(_eval_model, X, y))
+    return tuple(accs)
+
+
+def _write_checkpoint(path, arrays, metadata):
+    """
+    Write a checkpoint atomically: the file is written and synced under a
+    temporary name, then renamed over path, so that path always holds either
+    the previous complete checkpoint or the new one.
+    """
+    tmp_path = path + ".tmp"
+    save_arrays(tmp_path, arrays, metadata)
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _split_state(state, prefix, arrays):
+    """
+    Split a state dictionary such as an optim config into its arrays, which
+    are added to arrays under prefix + key, and its scalars, which are
+    returned. Values of other types are dropped.
+    """
+    scalars = {}
+    for key, value in state.items():
+        if key == "scratch":
+            # The scratch buffers of the in-place update rules hold no state.
+            continue
+        if isinstance(value, np.ndarray):
+            arrays[prefix + key] = value.copy()
+        elif isinstance(value, np.generic):
+            scalars[key] = value.item()
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            scalars[key] = value
+    return scalars
 
 
 class Solver(object):
@@ -101,9 +185,34 @@ class Solver(object):
           'learning_rate' parameter so that should always be present.
         - lr_decay: A scalar for learning rate decay; after each epoch the
           learning rate is multiplied by this value.
+        - lr_schedule: A per-iteration learning rate schedule from
+          lr_schedules.py, given as an LRSchedule instance or by name
+          ('constant', 'cosine', 'step', 'one_cycle' or 'plateau'). It scales
+          optim_config['learning_rate'] at every iteration, and cannot be
+          combined with lr_decay. Default is None.
+        - lr_schedule_config: A dictionary of keyword arguments for the
+          schedule when it is given by name, e.g. {'warmup_iters': 100}.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
+        - accumulate_steps: Number of minibatches of batch_size whose
+          gradients are averaged before each parameter update, which gives
+          the updates of a batch of accumulate_steps * batch_size examples
+          while only one minibatch is in memory at a time. An epoch then has
+          accumulate_steps times fewer iterations. Batch normalization still
+          computes its statistics over each minibatch of batch_size, and
+          updates its running averages once per minibatch; this is not the
+          same as batchnorm over the large batch, so batch_size should not
+          be too small. Default is 1.
         - num_epochs: The number of epochs to run for during training.
+        - prefetch: If True, minibatches are prepared by a PrefetchLoader
+          (see data_loader.py) in a background thread while the model
+          computes, and every epoch visits the training data in a new random
+          order without replacement. Otherwise each minibatch is sampled with
+          replacement on the training thread. Default is False.
+        - batch_dtype: With prefetch, the dtype the minibatches of X_train are
+          converted to, e.g. np.float32 for data stored as uint8.
+        - augment: With prefetch, an optional function augment(X_batch, rng)
+          that augments each minibatch in place in the background thread.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
         - verbose: Boolean; if set to false then no output will be printed
@@ -112,8 +221,27 @@ class Solver(object):
           accuracy; default is 1000; set to None to use entire training set.
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
-        - checkpoint_name: If not None, then save model checkpoints here every
-          epoch.
+        - checkpoint_name: If not None, then save checkpoints to
+          checkpoint_name + '_epoch_%d.ckpt' whenever the accuracy is checked.
+          A checkpoint holds the parameters, the optimizer state, the
+          batchnorm running averages, the random generator states and the
+          training progress, in the array format of model_io.py; training
+          can be continued from it with resume(). Checkpoints are written in
+          a background thread from a copy of the state, to a temporary file
+          that is then renamed, so an interrupted write never leaves a
+          truncated checkpoint behind.
+        - checkpoint_keep: If not None, only the checkpoint_keep most recent
+          checkpoints are kept; older ones are deleted. After resume(), this
+          includes the checkpoints already saved under checkpoint_name.
+          Default is None.
+        - async_eval: If True, the train and val accuracy are computed in a
+          worker process on a snapshot of the parameters (and batchnorm
+          running averages), while training continues. The model and the
+          data are sent to the worker once, when training starts. Results
+          are merged into the histories, the best parameters, the learning
+          rate schedule and the checkpoints as they arrive, so a plateau
+          schedule sees them a few iterations late. train() waits for all
+          of them before it returns. Default is False.
         """
         self.model = model
         self.X_train = data["X_train"]
@@ -125,14 +253,23 @@ class Solver(object):
         self.update_rule = kwargs.pop("update_rule", "sgd")
         self.optim_config = kwargs.pop("optim_config", {})
         self.lr_decay = kwargs.pop("lr_decay", 1.0)
+        self.lr_schedule = kwargs.pop("lr_schedule", None)
+        self.lr_schedule_config = kwargs.pop("lr_schedule_config", {})
         self.batch_size = kwargs.pop("batch_size", 100)
+        self.accumulate_steps = kwargs.pop("accumulate_steps", 1)
         self.num_epochs = kwargs.pop("num_epochs", 10)
         self.num_train_samples = kwargs.pop("num_train_samples", 1000)
         self.num_val_samples = kwargs.pop("num_val_samples", None)
 
         self.checkpoint_name = kwargs.pop("checkpoint_name", None)
+        self.checkpoint_keep = kwargs.pop("checkpoint_keep", None)
         self.print_every = kwargs.pop("print_every", 10)
         self.verbose = kwargs.pop("verbose", True)
+        self.async_eval = kwargs.pop("async_eval", False)
+        self.prefetch = kwargs.pop("prefetch", False)
+        self.batch_dtype = kwargs.pop("batch_dtype", None)
+        self.augment = kwargs.pop("augment", None)
+        self.loader = None
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -145,6 +282,18 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        # Likewise for a learning rate schedule given by name.
+        if isinstance(self.lr_schedule, str):
+            if self.lr_schedule not in lr_schedules.SCHEDULES:
+                raise ValueError('Invalid lr_schedule "%s"' % self.lr_schedule)
+            schedule_class = lr_schedules.SCHEDULES[self.lr_schedule]
+            self.lr_schedule = schedule_class(**self.lr_schedule_config)
+        if self.lr_schedule is not None:
+            if self.lr_decay != 1.0:
+                raise ValueError("lr_decay cannot be combined with lr_schedule")
+            if "learning_rate" not in self.optim_config:
+                raise ValueError("lr_schedule requires optim_config['learning_rate']")
+
         self._reset()
 
     def _reset(self):
@@ -159,6 +308,18 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self.lr_history = []
+        self.overlap_ratio = None
+        self._eval_executor = None
+        self._pending_evals = []
+        self._checkpoint_executor = None
+        self._checkpoint_futures = []
+        self._checkpoint_files = []
+
+        # Number of iterations done so far in the run, and the iteration the
+        # next call to train() starts from, which resume() sets.
+        self._iteration = 0
+        self._start_iteration = 0
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -166,50 +327,311 @@ class Solver(object):
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
 
+        # Gradient accumulators for accumulate_steps > 1, allocated on the
+        # first step and reused afterwards.
+        self.grad_accumulators = {}
+
     def _step(self):
         """
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
-
-        # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.accumulate_steps == 1:
+            loss, grads = self._minibatch_loss()
+            found_inf = getattr(self.model, "found_inf", False)
+        else:
+            loss, grads, found_inf = self._accumulate_grads()
         self.loss_history.append(loss)
 
-        # Perform a parameter update
+        # Models trained with dynamic loss scaling set found_inf when the
+        # gradients of this step overflowed; skip the update in that case.
+        if found_inf:
+            return
+
+        # Perform a parameter update. Parameters without a gradient (for
+        # example those of frozen layers) are left unchanged.
         for p, w in self.model.params.items():
+            if p not in grads:
+                continue
             dw = grads[p]
             config = self.optim_configs[p]
             next_w, next_config = self.update_rule(w, dw, config)
             self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
+    def _minibatch_loss(self):
+        """Compute the loss and gradients on a random minibatch of training data."""
+        if self.loader is not None:
+            X_batch, y_batch = self.loader.next_batch()
+            return self.model.loss(X_batch, y_batch)
+        num_train = self.X_train.shape[0]
+        batch_mask = np.random.choice(num_train, self.batch_size)
+        X_batch = self.X_train[batch_mask]
+        y_batch = self.y_train[batch_mask]
+        return self.model.loss(X_batch, y_batch)
+
+    def _accumulate_grads(self):
+        """
+        Average the loss and gradients of accumulate_steps minibatches. The
+        gradients are summed into self.grad_accumulators, so no new arrays
+        are allocated beyond those of the model's own backward pass.
+
+        Returns a tuple of:
+        - loss: The average loss
+        - grads: Dictionary of the average gradients, which are the arrays in
+          self.grad_accumulators
+        - found_inf: True if the gradients of any minibatch overflowed
+        """
+        loss, found_inf = 0.0, False
+        for step in range(self.accumulate_steps):
+            step_loss, step_grads = self._minibatch_loss()
+            loss += step_loss
+            found_inf = found_inf or getattr(self.model, "found_inf", False)
+            for p, g in step_grads.items():
+                acc = self.grad_accumulators.get(p)
+                if acc is None or acc.shape != g.shape:
+                    acc = self.grad_accumulators[p] = np.empty_like(g)
+                if step == 0:
+                    np.copyto(acc, g)
+                else:
+                    acc += g
+        grads = {p: self.grad_accumulators[p] for p in step_grads}
+        for g in grads.values():
+            g /= self.accumulate_steps
+        return loss / self.accumulate_steps, grads, found_inf
+
+    def _checkpoint_state(self):
+        """
+        Copy the state needed to continue training into arrays and
+        JSON-serializable metadata for save_arrays.
+        """
+        arrays = {"params/" + k: v.copy() for k, v in self.model.params.items()}
+        for k, v in self.best_params.items():
+            arrays["best_params/" + k] = v.copy()
+        optim_state = {}
+        for p, config in self.optim_configs.items():
+            optim_state[p] = _split_state(config, "optim/%s/" % p, arrays)
+        for j, bn_param in enumerate(getattr(self.model, "bn_params", [])):
+            for key in ("running_mean", "running_var"):
+                if key in bn_param:
+                    arrays["bn_params/%d/%s" % (j, key)] = bn_param[key].copy()
+        arrays["history/loss"] = np.array(self.loss_history, dtype=np.float64)
+        arrays["history/train_acc"] = np.array(self.train_acc_history, dtype=np.float64)
+        arrays["history/val_acc"] = np.array(self.val_acc_history, dtype=np.float64)
+        arrays["history/lr"] = np.array(self.lr_history, dtype=np.float64)
+
+        # The global generator samples the minibatches and accuracy subsets;
+        # the dropout layers and the sampled softmax may draw from generators
+        # of their own.
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        arrays["rng/keys"] = keys
+        dropout_rngs = [
+            dropout_param["rng"].bit_generator.state if "rng" in dropout_param else None
+            for dropout_param in getattr(self.model, "dropout_params", [])
+        ]
+        output_loss_param = getattr(self.model, "output_loss_param", {})
+        output_loss_rng = None
+        if "rng" in output_loss_param:
+            output_loss_rng = output_loss_param["rng"].bit_generator.state
+        metadata = {
+            "iteration": self._iteration,
+            "epoch": self.epoch,
+            "best_val_acc": float(self.best_val_acc),
+            "batch_size": self.batch_size,
+            "accumulate_steps": self.accumulate_steps,
+            "optim": optim_state,
+            "rng": [pos, has_gauss, cached_gaussian],
+            "dropout_rngs": dropout_rngs,
+            "output_loss_rng": output_loss_rng,
+        }
+        # Dynamic loss scaling doubles the scale after a number of steps
+        # without overflow, which are counted in _good_steps.
+        if hasattr(self.model, "loss_scale"):
+            metadata["loss_scale"] = float(self.model.loss_scale)
+            metadata["good_steps"] = int(getattr(self.model, "_good_steps", 0))
+        if self.lr_schedule is not None:
+            metadata["lr_schedule"] = _split_state(vars(self.lr_schedule), "lr_schedule/", arrays)
+        return arrays, metadata
+
     def _save_checkpoint(self):
+        """
+        Snapshot the training state and hand it to the checkpoint writer
+        thread, which writes it while training continues.
+        """
         if self.checkpoint_name is None:
             return
-        checkpoint = {
-            "model": self.model,
-            "update_rule": self.update_rule,
-            "lr_decay": self.lr_decay,
-            "optim_config": self.optim_config,
-            "batch_size": self.batch_size,
-            "num_train_samples": self.num_train_samples,
-            "num_val_samples": self.num_val_samples,
-            "epoch": self.epoch,
-            "loss_history": self.loss_history,
-            "train_acc_history": self.train_acc_history,
-            "val_acc_history": self.val_acc_history,
-        }
-        filename = "%s_epoch_%d.pkl" % (self.checkpoint_name, self.epoch)
+        filename = "%s_epoch_%d.ckpt" % (self.checkpoint_name, self.epoch)
+        arrays, metadata = self._checkpoint_state()
+        if self._checkpoint_executor is None:
+            self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        # Surface errors of earlier writes instead of letting them pile up.
+        for future in self._checkpoint_futures:
+            if future.done():
+                future.result()
+        self._checkpoint_futures = [f for f in self._checkpoint_futures if not f.done()]
         if self.verbose:
             print('Saving checkpoint to "%s"' % filename)
-        with open(filename, "wb") as f:
-            pickle.dump(checkpoint, f)
+        future = self._checkpoint_executor.submit(self._write_checkpoint, filename, arrays, metadata)
+        self._checkpoint_futures.append(future)
+
+    def _write_checkpoint(self, filename, arrays, metadata):
+        """Write a checkpoint and delete the ones beyond checkpoint_keep. Runs in the writer thread."""
+        _write_checkpoint(filename, arrays, metadata)
+        if filename in self._checkpoint_files:
+            self._checkpoint_files.remove(filename)
+        self._checkpoint_files.append(filename)
+        if self.checkpoint_keep is not None:
+            while len(self._checkpoint_files) > self.checkpoint_keep:
+                old = self._checkpoint_files.pop(0)
+                if os.path.exists(old):
+                    os.remove(old)
+
+    def _wait_checkpoints(self):
+        """Wait until all checkpoints are written, and raise any error of the writer."""
+        if self._checkpoint_executor is not None:
+            self._checkpoint_executor.shutdown(wait=True)
+            self._checkpoint_executor = None
+        futures, self._checkpoint_futures = self._checkpoint_futures, []
+        for future in futures:
+            future.result()
+
+    def resume(self, path):
+        """
+        Restore the training state saved in a checkpoint, so that the next
+        call to train() continues the interrupted run from the iteration at
+        which the checkpoint was written. The Solver must have been
+        constructed with the same model architecture, data and options as
+        the run that wrote the checkpoint.
+
+        With prefetch, the resumed run shuffles the training data in a
+        different order than the interrupted one would have; with async_eval,
+        evaluations still pending when the checkpoint was written are lost.
+
+        Inputs:
+        - path: Path of a checkpoint written by this Solver
+        """
+        arrays, metadata = load_arrays(path, mmap_mode=None)
+        for key in ("batch_size", "accumulate_steps"):
+            if metadata[key] != getattr(self, key):
+                raise ValueError(
+                    'Checkpoint "%s" was written with %s=%d, not %d'
+                    % (path, key, metadata[key], getattr(self, key))
+                )
+
+        self._reset()
+        self.model.params = {}
+        for p, state in metadata["optim"].items():
+            self.optim_configs[p] = dict(state)
+        bn_params = getattr(self.model, "bn_params", [])
+        lr_schedule_state = metadata.get("lr_schedule", {})
+        for name, arr in arrays.items():
+            parts = name.split("/")
+            if parts[0] == "params":
+                self.model.params[parts[1]] = arr
+            elif parts[0] == "best_params":
+                self.best_params[parts[1]] = arr
+            elif parts[0] == "optim":
+                self.optim_configs[parts[1]][parts[2]] = arr
+            elif parts[0] == "bn_params":
+                bn_params[int(parts[1])][parts[2]] = arr
+            elif parts[0] == "lr_schedule":
+                lr_schedule_state[parts[1]] = arr
+        self.loss_history = arrays["history/loss"].tolist()
+        self.train_acc_history = arrays["history/train_acc"].tolist()
+        self.val_acc_history = arrays["history/val_acc"].tolist()
+        self.lr_history = arrays["history/lr"].tolist()
+        self.epoch = metadata["epoch"]
+        self.best_val_acc = metadata["best_val_acc"]
+        self._start_iteration = metadata["iteration"]
+
+        np.random.set_state(("MT19937", arrays["rng/keys"]) + tuple(metadata["rng"]))
+        dropout_params = getattr(self.model, "dropout_params", [])
+        for dropout_param, state in zip(dropout_params, metadata["dropout_rngs"]):
+            if state is not None:
+                dropout_param["rng"].bit_generator.state = state
+        if metadata.get("output_loss_rng") is not None:
+            self.model.output_loss_param["rng"].bit_generator.state = metadata["output_loss_rng"]
+        if "loss_scale" in metadata:
+            self.model.loss_scale = metadata["loss_scale"]
+            self.model._good_steps = metadata.get("good_steps", 0)
+        if self.lr_schedule is not None:
+            vars(self.lr_schedule).update(lr_schedule_state)
+
+        # Let checkpoint_keep also count the checkpoints that earlier runs
+        # wrote under the same name, oldest epoch first.
+        if self.checkpoint_name is not None:
+            pattern = glob.escape(self.checkpoint_name) + "_epoch_*.ckpt"
+            epochs = {}
+            for filename in glob.glob(pattern):
+                match = re.search(r"_epoch_(\d+)\.ckpt$", filename)
+                if match:
+                    epochs[filename] = int(match.group(1))
+            self._checkpoint_files = sorted(epochs, key=epochs.get)
+
+    def _sample_mask(self, N, num_samples):
+        """Indices of a random subsample of num_samples out of N, or None."""
+        if num_samples is not None and N > num_samples:
+            return np.random.choice(N, num_samples)
+        return None
+
+    def _record_accuracy(self, epoch, train_acc, val_acc, params=None):
+        """
+        Record the train and val accuracy of the parameters at the given
+        epoch, which default to the current ones, and keep track of the best.
+        """
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+        if self.lr_schedule is not None:
+            self.lr_schedule.observe(val_acc)
+
+        if self.verbose:
+            print(
+                "(Epoch %d / %d) train acc: %f; val_acc: %f"
+                % (epoch, self.num_epochs, train_acc, val_acc)
+            )
+
+        # Keep track of the best model
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            if params is None:
+                params = {k: v.copy() for k, v in self.model.params.items()}
+            self.best_params = params
+        self._save_checkpoint()
+
+    def _submit_eval(self):
+        """Start evaluating a snapshot of the current parameters in the worker."""
+        if self._eval_executor is None:
+            data = {
+                "X_train": self.X_train, "y_train": self.y_train,
+                "X_val": self.X_val, "y_val": self.y_val,
+            }
+            self._eval_executor = ProcessPoolExecutor(
+                max_workers=1, initializer=_init_eval_worker, initargs=(self.model, data)
+            )
+        params = {k: v.copy() for k, v in self.model.params.items()}
+        bn_params = getattr(self.model, "bn_params", None)
+        if bn_params is not None:
+            bn_params = [
+                {k: np.copy(v) if isinstance(v, np.ndarray) else v for k, v in bn_param.items()}
+                for bn_param in bn_params
+            ]
+        train_mask = self._sample_mask(self.X_train.shape[0], self.num_train_samples)
+        val_mask = self._sample_mask(self.X_val.shape[0], self.num_val_samples)
+        future = self._eval_executor.submit(_evaluate, params, bn_params, train_mask, val_mask)
+        self._pending_evals.append((self.epoch, params, future))
+
+    def _merge_evals(self, wait=False):
+        """
+        Record the results of finished evaluations, in the order in which they
+        were submitted. If wait is True, wait for all of them.
+        """
+        while self._pending_evals:
+            epoch, params, future = self._pending_evals[0]
+            if not wait and not future.done():
+                break
+            train_acc, val_acc = future.result()
+            self._pending_evals.pop(0)
+            self._record_accuracy(epoch, train_acc, val_acc, params)
 
     def check_accuracy(self, X, y, num_samples=None, batch_size=100):
         """
@@ -229,25 +651,12 @@ class Solver(object):
         """
 
         # Maybe subsample the data
-        N = X.shape[0]
-        if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
+        mask = self._sample_mask(X.shape[0], num_samples)
+        if mask is not None:
             X = X[mask]
             y = y[mask]
 
-        # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
+        acc = _accuracy(self.model, X, y, batch_size)
 
         return acc
 
@@ -256,54 +665,80 @@ class Solver(object):
         Run optimization to train the model.
         """
         num_train = self.X_train.shape[0]
-        iterations_per_epoch = max(num_train // self.batch_size, 1)
+        iterations_per_epoch = max(num_train // (self.batch_size * self.accumulate_steps), 1)
         num_iterations = self.num_epochs * iterations_per_epoch
-
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print(
-                    "(Iteration %d / %d) loss: %f"
-                    % (t + 1, num_iterations, self.loss_history[-1])
-                )
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]["learning_rate"] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            first_it = t == 0
-            last_it = t == num_iterations - 1
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(
-                    self.X_train, self.y_train, num_samples=self.num_train_samples
-                )
-                val_acc = self.check_accuracy(
-                    self.X_val, self.y_val, num_samples=self.num_val_samples
-                )
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
-
-                if self.verbose:
+        if self.lr_schedule is not None:
+            self.lr_schedule.begin(num_iterations, iterations_per_epoch)
+
+        if self.prefetch:
+            # The loader's generator is seeded from np.random, so that
+            # np.random.seed still makes training reproducible.
+            self.loader = PrefetchLoader(
+                self.X_train, self.y_train, self.batch_size, dtype=self.batch_dtype,
+                augment=self.augment, seed=np.random.randint(2 ** 31),
+            )
+        start_iteration, self._start_iteration = self._start_iteration, 0
+        self._iteration = start_iteration
+        try:
+            for t in range(start_iteration, num_iterations):
+                if self.lr_schedule is not None:
+                    lr = self.optim_config["learning_rate"] * self.lr_schedule(t)
+                    for k in self.optim_configs:
+                        self.optim_configs[k]["learning_rate"] = lr
+                    self.lr_history.append(lr)
+                self._step()
+                self._iteration = t + 1
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
                     print(
-                        "(Epoch %d / %d) train acc: %f; val_acc: %f"
-                        % (self.epoch, self.num_epochs, train_acc, val_acc)
+                        "(Iteration %d / %d) loss: %f"
+                        % (t + 1, num_iterations, self.loss_history[-1])
                     )
 
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+                # At the end of every epoch, increment the epoch counter and decay
+                # the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        # Configs of never-updated (frozen) parameters have no
+                        # learning rate filled in by the update rule yet.
+                        if "learning_rate" in self.optim_configs[k]:
+                            self.optim_configs[k]["learning_rate"] *= self.lr_decay
+
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
+                first_it = t == 0
+                last_it = t == num_iterations - 1
+                if first_it or last_it or epoch_end:
+                    if self.async_eval:
+                        self._submit_eval()
+                    else:
+                        train_acc = self.check_accuracy(
+                            self.X_train, self.y_train, num_samples=self.num_train_samples
+                        )
+                        val_acc = self.check_accuracy(
+                            self.X_val, self.y_val, num_samples=self.num_val_samples
+                        )
+                        self._record_accuracy(self.epoch, train_acc, val_acc)
+                if self.async_eval:
+                    self._merge_evals(wait=last_it)
+        finally:
+            if self._eval_executor is not None:
+                self._eval_executor.shutdown(wait=True)
+                self._eval_executor = None
+                self._pending_evals = []
+            if self.loader is not None:
+                self.loader.close()
+                self.overlap_ratio = self.loader.overlap_ratio()
+                self.loader = None
+            if self._checkpoint_executor is not None:
+                self._checkpoint_executor.shutdown(wait=True)
+                self._checkpoint_executor = None
+        self._wait_checkpoints()
+        if self.verbose and self.overlap_ratio is not None:
+            print("Data loading overlapped with computation: %.0f%%" % (100 * self.overlap_ratio))
 
         # At the end of training swap the best params into the model
         self.model.params = self.best_params